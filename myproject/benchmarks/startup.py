@@ -0,0 +1,93 @@
+# startup.py
+# Measures the cold start cost of the WSGI application: how long `myproject.wsgi` takes to import, how long the first
+# request takes (which is when Django loads the URLconf and views), and how much memory the worker holds afterwards.
+# Each sample runs in a fresh interpreter, as App Engine does when scaling from zero.
+#
+# Usage (from the myproject directory):
+#     $ python benchmarks/startup.py --runs 10 --path /signup/
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Modules that shouldn't be loaded until a request actually needs them
+HEAVY_MODULES = ["pandas", "numpy", "cachetools", "myapp.teamBalancer"]
+
+PROBE = """
+import io, json, resource, sys, time
+from wsgiref.util import setup_testing_defaults
+
+baseline_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+start = time.perf_counter()
+from myproject.wsgi import application
+imported = time.perf_counter()
+
+environ = {"PATH_INFO": sys.argv[1], "HTTP_HOST": "127.0.0.1", "wsgi.errors": io.StringIO()}
+setup_testing_defaults(environ)
+response = application(environ, lambda status, headers: None)
+b"".join(response)
+response.close()
+responded = time.perf_counter()
+
+print(json.dumps({
+    "import_ms": (imported - start) * 1000,
+    "first_request_ms": (responded - imported) * 1000,
+    "rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    "baseline_rss_kb": baseline_kb,
+    "loaded": [m for m in %r if m in sys.modules],
+}))
+""" % HEAVY_MODULES
+
+
+def sample(settings, path):
+    """
+    Import the WSGI application and serve one request in a fresh interpreter.
+    :param settings: Django settings module to boot with.
+    :param path: URL path of the first request.
+    :return: Import time, first request time, peak RSS and heavy modules loaded along the way.
+    :rtype: dict
+    """
+    # The ratings refresher would build its snapshot alongside the first request and skew its timing
+    env = dict(os.environ, DJANGO_SETTINGS_MODULE=settings, RATINGS_SNAPSHOT_PRELOAD="False")
+    process = subprocess.run([sys.executable, "-c", PROBE, path], cwd=BASE_DIR, env=env,
+                             capture_output=True, text=True)
+    if process.returncode != 0:
+        sys.exit(process.stderr)
+    return json.loads(process.stdout.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark WSGI application import time and memory.")
+    parser.add_argument("--runs", type=int, default=5, help="Number of fresh interpreters to sample.")
+    parser.add_argument("--path", default="/signup/", help="URL path of the first request.")
+    parser.add_argument("--settings", default=os.getenv("DJANGO_SETTINGS_MODULE", "myproject.settings"))
+    parser.add_argument("--json", action="store_true", help="Print raw samples as JSON.")
+    args = parser.parse_args()
+
+    samples = [sample(args.settings, args.path) for _ in range(args.runs)]
+
+    if args.json:
+        print(json.dumps(samples, indent=2))
+        return
+
+    import_ms = [s["import_ms"] for s in samples]
+    first_request_ms = [s["first_request_ms"] for s in samples]
+    rss_mb = [s["rss_kb"] / 1024 for s in samples]  # ru_maxrss is in kilobytes on Linux
+    loaded = sorted(set(m for s in samples for m in s["loaded"]))
+
+    print(f"runs:           {args.runs}")
+    print(f"import time:    median {statistics.median(import_ms):.1f} ms, "
+          f"min {min(import_ms):.1f} ms, max {max(import_ms):.1f} ms")
+    print(f"first request:  median {statistics.median(first_request_ms):.1f} ms ({args.path})")
+    print(f"peak RSS:       median {statistics.median(rss_mb):.1f} MB "
+          f"(bare interpreter {samples[0]['baseline_rss_kb'] / 1024:.1f} MB)")
+    print(f"heavy modules:  {', '.join(loaded) if loaded else 'none'}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,4 +1,114 @@
 from django.contrib import admin
+from django.core.paginator import Paginator
+from django.template.response import TemplateResponse
+from django.urls import path
 
-# Register your models here.
+from .instrumentation import query_budget
+from .leagues import get_weight_profiles
+from .models import BalancingJob, League, Membership, RatingsHistory, Roster, Votes, WeightProfile
+from .ratings import SKILLS, player_ratings
 
+
+class MembershipInline(admin.TabularInline):
+    model = Membership
+    raw_id_fields = ('user',)
+    extra = 0
+
+
+@admin.register(League)
+class LeagueAdmin(admin.ModelAdmin):
+    list_display = ('name', 'slug', 'created_date')
+    prepopulated_fields = {'slug': ('name',)}
+    inlines = [MembershipInline]
+
+
+@admin.register(WeightProfile)
+class WeightProfileAdmin(admin.ModelAdmin):
+    list_display = ('name', 'league') + SKILLS + ('is_default',)
+    list_select_related = ('league',)
+    list_filter = ('league',)
+
+
+@admin.register(Votes)
+class VotesAdmin(admin.ModelAdmin):
+    """
+    Votes, newest first. Pages are ordered by primary key so they come straight off an index, and the full result
+    count is skipped when filtering, which would mean counting every vote again.
+    """
+    list_display = ('player', 'user', 'league') + SKILLS + ('published_date',)
+    list_select_related = ('user', 'league')
+    list_filter = ('league',)
+    search_fields = ('player',)
+    ordering = ('-pk',)
+    list_per_page = 100
+    show_full_result_count = False
+    raw_id_fields = ('user',)
+    change_list_template = 'admin/myapp/votes/change_list.html'
+
+    ratings_per_page = 100
+
+    def get_urls(self):
+        return [
+            path('ratings/', query_budget(6)(self.admin_site.admin_view(self.player_ratings_view)),
+                 name='myapp_votes_ratings'),
+        ] + super(VotesAdmin, self).get_urls()
+
+    def player_ratings_view(self, request):
+        """
+        Every player in a league with their average rating per skill, how many votes they've had, and their overall
+        score under the league's default weight profile. Averages are worked out by the database with one grouped
+        query per page, ordered by the (league, player) index. Looking doesn't create anything: with no leagues yet
+        the page is empty.
+        :param request:
+        :return:
+        """
+        leagues = list(League.objects.order_by('name'))
+        league = (next((l for l in leagues if str(l.pk) == request.GET.get('league')), None)
+                  or next((l for l in leagues if l.slug == League.DEFAULT_SLUG), None)
+                  or next(iter(leagues), None))
+
+        profiles = get_weight_profiles(league) if league else []
+        rows = player_ratings(league, profiles[0].as_weights() if profiles else None) if league else []
+        page = Paginator(rows, self.ratings_per_page).get_page(request.GET.get('p'))
+
+        context = dict(
+            self.admin_site.each_context(request),
+            title="Player ratings",
+            opts=self.model._meta,
+            leagues=leagues,
+            league=league,
+            weight_profile=profiles[0] if profiles else None,
+            skills=SKILLS,
+            page=page,
+            rows=[(row['player'], row['votes'], [row[f"avg_{skill}"] for skill in SKILLS], row['overall'])
+                  for row in page],
+        )
+        return TemplateResponse(request, 'admin/myapp/votes/player_ratings.html', context)
+
+
+@admin.register(Roster)
+class RosterAdmin(admin.ModelAdmin):
+    list_display = ('published_date', 'user', 'league', 'weight_profile', 'players')
+    list_select_related = ('user', 'league', 'weight_profile')
+    list_filter = ('league',)
+    ordering = ('-pk',)
+    list_per_page = 100
+    show_full_result_count = False
+    raw_id_fields = ('user',)
+
+
+@admin.register(BalancingJob)
+class BalancingJobAdmin(admin.ModelAdmin):
+    list_display = ('pk', 'status', 'user', 'league', 'created_date', 'started_date', 'finished_date')
+    list_select_related = ('user', 'league')
+    list_filter = ('status', 'league')
+    ordering = ('-pk',)
+    raw_id_fields = ('user', 'roster')
+
+
+@admin.register(RatingsHistory)
+class RatingsHistoryAdmin(admin.ModelAdmin):
+    list_display = ('created_date', 'league')
+    list_select_related = ('league',)
+    list_filter = ('league',)
+    ordering = ('-pk',)
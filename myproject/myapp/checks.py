@@ -0,0 +1,23 @@
+# checks.py
+# System checks for settings that work in development but not once the app runs in more than one process.
+
+from django.conf import settings
+from django.core.checks import Warning, register
+
+
+@register()
+def shared_cache_check(app_configs, **kwargs):
+    """
+    Warn when production runs with a local memory cache, where a vote saved by one worker never invalidates what the
+    others have cached.
+    """
+    if settings.DEBUG or getattr(settings, 'TESTING', False):
+        return []
+    if not settings.CACHES['default']['BACKEND'].endswith('.LocMemCache'):
+        return []
+    return [Warning(
+        "The cache is local to each process, so cached directories and vote lists go stale for up to CACHE_TIMEOUT "
+        "seconds in every other worker.",
+        hint="Set MEMCACHED_LOCATION, or CACHE_BACKEND to the database cache as a fallback.",
+        id='myapp.W001',
+    )]
@@ -0,0 +1,17 @@
+from django.utils.functional import SimpleLazyObject
+
+from .leagues import get_active_league, get_other_leagues
+
+
+def league(request):
+    """
+    Adds the user's active league, and the other leagues they can switch to, to every template. Both are only looked
+    up if the template uses them, so pages without the league bar (e.g. the admin) don't pay for it.
+    """
+    if not request.user.is_authenticated:
+        return {}
+
+    return {
+        'league': SimpleLazyObject(lambda: get_active_league(request)),
+        'other_leagues': SimpleLazyObject(lambda: get_other_leagues(request)),
+    }
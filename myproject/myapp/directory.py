@@ -0,0 +1,72 @@
+# directory.py
+# Cached directory of each league's players, used to build the player choices on the voting and roster forms. A
+# league's name list is built with one query and cached until one of its players changes their name, or someone joins or
+# leaves it; each voter's "not yet voted" list is cached on top of it until they vote again.
+
+from django.contrib.auth.models import User
+from django.core.cache import cache
+
+from .models import Votes
+from .versions import get_version
+
+
+def get_players(league):
+    """
+    Get every player in a league.
+    :param league: League to list.
+    :return: (user id, "First Last") tuples, in the order the players registered
+    :rtype: list
+    """
+    key = f"myapp:directory:{league.pk}:{get_version(f'directory:{league.pk}')}"
+    players = cache.get(key)
+    if players is None:
+        users = User.objects.filter(memberships__league=league).order_by('pk').values_list(
+            'pk', 'first_name', 'last_name')
+        players = [(pk, f"{first_name} {last_name}") for pk, first_name, last_name in users]
+        cache.set(key, players)
+    return players
+
+
+def get_player_names(league):
+    """
+    :param league: League to list.
+    :return: Names of every player in the league
+    :rtype: list
+    """
+    return [name for pk, name in get_players(league)]
+
+
+def get_voted_players(uid, league):
+    """
+    :param uid: ID of the voter.
+    :param league: League the votes were cast in.
+    :return: Names of the players the user has already voted on
+    :rtype: frozenset
+    """
+    key = f"myapp:voted:{league.pk}:{uid}:{get_version(f'votes:{uid}')}"
+    voted = cache.get(key)
+    if voted is None:
+        voted = frozenset(Votes.objects.filter(league=league, user_id=uid).values_list('player', flat=True))
+        cache.set(key, voted)
+    return voted
+
+
+def get_unvoted_players(uid, league):
+    """
+    Names of the players in a league a user still has to vote on, i.e. everyone except themselves and the players
+    they've already voted on.
+    :param uid: ID of the voter, or None for every player.
+    :param league: League to list.
+    :return: Player names
+    :rtype: list
+    """
+    if uid is None:
+        return get_player_names(league)
+
+    key = f"myapp:unvoted:{league.pk}:{uid}:{get_version(f'directory:{league.pk}')}:{get_version(f'votes:{uid}')}"
+    unvoted = cache.get(key)
+    if unvoted is None:
+        voted = get_voted_players(uid, league)
+        unvoted = [name for pk, name in get_players(league) if pk != uid and name not in voted]
+        cache.set(key, unvoted)
+    return unvoted
@@ -0,0 +1,72 @@
+# exports.py
+# Streams tables out as CSV or JSON for coaches' spreadsheets. Rows are written out one at a time as the database
+# hands them over, from a queryset's iterator(), which reads through a server-side cursor on PostgreSQL and in chunks
+# elsewhere, so memory stays flat however many rows there are.
+
+import csv
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.http import StreamingHttpResponse
+
+
+FORMATS = {
+    'csv': 'text/csv',
+    'json': 'application/json',
+}
+
+CHUNK_SIZE = 2000  # rows fetched from the cursor at a time
+
+
+class Echo:
+    """
+    File-like object for csv.writer that hands each line back instead of keeping it.
+    """
+
+    def write(self, value):
+        return value
+
+
+def stream_csv(header, rows):
+    """
+    :param header: List of column names.
+    :param rows: Iterable of lists of values, in the order of the header. Values that are lists, e.g. of players,
+        are joined into one cell.
+    :return: Lines of CSV
+    :rtype: generator
+    """
+    writer = csv.writer(Echo())
+    yield writer.writerow(header)
+    for row in rows:
+        yield writer.writerow(["; ".join(value) if isinstance(value, list) else value for value in row])
+
+
+def stream_json(header, rows):
+    """
+    :param header: List of column names.
+    :param rows: Iterable of lists of values, in the order of the header.
+    :return: Pieces of a JSON array of objects, one per row
+    :rtype: generator
+    """
+    encoder = DjangoJSONEncoder()
+    yield '['
+    separator = ''
+    for row in rows:
+        yield separator + encoder.encode(dict(zip(header, row)))
+        separator = ',\n'
+    yield ']\n'
+
+
+def export_response(fmt, filename, header, rows):
+    """
+    Stream rows out as a file download.
+    :param fmt: 'csv' or 'json'.
+    :param filename: Name of the file without its extension.
+    :param header: List of column names.
+    :param rows: Iterable of lists of values. It's only read as the response is sent.
+    :return:
+    :rtype: StreamingHttpResponse
+    """
+    stream = stream_csv if fmt == 'csv' else stream_json
+    response = StreamingHttpResponse(stream(header, rows), content_type=FORMATS[fmt])
+    response['Content-Disposition'] = f'attachment; filename="{filename}.{fmt}"'
+    return response
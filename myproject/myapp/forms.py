@@ -1,8 +1,10 @@
 from django import forms
+from django.core.exceptions import ValidationError
 from django.contrib.auth.forms import UserCreationForm
 from django.contrib.auth.models import User
 
 from .models import Votes, Roster
+from . import directory, leagues
 
 
 class RegistrationForm(UserCreationForm):
@@ -32,11 +34,13 @@ class VotingForm(forms.ModelForm):
         Creates a dynamic drop down form field of registered users. Excludes logged in user and any players that the
         logged in user has already voted on.
         :param uid: ID of the currently logged in user.
+        :param league: League the vote is cast in. Only players in the league can be voted on.
         :param args:
         :param kwargs:
         """
 
         uid = kwargs.pop('uid', None)
+        league = kwargs.pop('league', None)
 
         super(VotingForm, self).__init__(*args, **kwargs)
 
@@ -46,24 +50,137 @@ class VotingForm(forms.ModelForm):
             self.fields['player'].disabled = True
             # self.fields['created_date'].disabled = True
         else:
-            # Get list of names of all users, excluding currently logged in user
-            users = User.objects.values().exclude(id=uid)
-            first_names = users.values_list('first_name', flat=True)
-            last_names = users.values_list('last_name', flat=True)
+            # Players that don't match current user and haven't been voted on
+            valid_players = directory.get_unvoted_players(uid, league)
+            form_user_choices = list(zip(valid_players, valid_players))
 
-            human_names = []
-            for i in range(len(first_names)):
-                human_names.append(f"{first_names[i]} {last_names[i]}")
+            self.fields['player'] = forms.ChoiceField(choices=form_user_choices)
 
-            # Players the user has already voted on
-            voted_players = list(
-                Votes.objects.filter(user_id=uid).values_list('player', flat=True))  # returns an iterable
 
-            # Return players that don't match current user and haven't been voted on
-            valid_players = [name for name in human_names if name not in voted_players]
-            form_user_choices = list(zip(valid_players, valid_players))
+class BulkVoteForm(forms.ModelForm):
+    """
+    One row of the bulk rating page: a player and their five skill ratings.
+    """
 
-            self.fields['player'] = forms.ChoiceField(choices=form_user_choices)
+    skip = forms.BooleanField(required=False)
+
+    class Meta:
+        model = Votes
+        fields = ('player',
+                  'attack',
+                  'defense',
+                  'possession',
+                  'stamina',
+                  'mobility',)
+        widgets = {'player': forms.HiddenInput()}
+
+    def __init__(self, *args, **kwargs):
+        """
+        Players can only be rated once, so rows for existing votes keep their player, and rows for new votes only
+        accept players the user hasn't voted on yet.
+        :param valid_players: Names of the players the user may add new votes for.
+        :param args:
+        :param kwargs:
+        """
+
+        valid_players = kwargs.pop('valid_players', ())
+
+        super(BulkVoteForm, self).__init__(*args, **kwargs)
+
+        if self.instance.pk:
+            self.fields['player'].disabled = True
+        else:
+            self.fields['player'] = forms.ChoiceField(choices=list(zip(valid_players, valid_players)),
+                                                      widget=forms.HiddenInput())
+
+
+class LoadedModelChoiceField(forms.ModelChoiceField):
+    """
+    Model choice field that looks submitted values up among objects that are already loaded, instead of running a
+    query per field like ModelChoiceField does.
+    """
+
+    def __init__(self, objects, *args, **kwargs):
+        """
+        :param objects: Dictionary of the valid choices, keyed by primary key.
+        """
+        self.objects = objects
+        super(LoadedModelChoiceField, self).__init__(*args, **kwargs)
+
+    def to_python(self, value):
+        if value in self.empty_values:
+            return None
+        try:
+            return self.objects[int(value)]
+        except (KeyError, TypeError, ValueError):
+            raise ValidationError(self.error_messages['invalid_choice'], code='invalid_choice')
+
+
+class BaseBulkVoteFormSet(forms.BaseModelFormSet):
+
+    def add_fields(self, form, index):
+        super(BaseBulkVoteFormSet, self).add_fields(form, index)
+
+        # Resolve each row's vote from the formset's own queryset, rather than with one query per row
+        if not hasattr(self, '_votes_by_pk'):
+            self._votes_by_pk = {vote.pk: vote for vote in self.get_queryset()}
+        id_field = form.fields['id']
+        form.fields['id'] = LoadedModelChoiceField(self._votes_by_pk, id_field.queryset, initial=id_field.initial,
+                                                   required=False, widget=id_field.widget)
+
+    def clean(self):
+        """
+        Make sure no player is rated twice in the same submission.
+        """
+        super(BaseBulkVoteFormSet, self).clean()
+
+        players = [form.cleaned_data.get('player') for form in self.forms if form.cleaned_data]
+        if len(players) != len(set(players)):
+            raise ValidationError("Each player can only be rated once.")
+
+    def votes_to_save(self):
+        """
+        Split the submitted rows into new votes and changed existing votes. Unchanged and skipped rows are left out.
+        :return: (new votes, changed votes)
+        :rtype: tuple
+        """
+        created, updated = [], []
+        for form in self.forms:
+            if form.cleaned_data.get('skip'):
+                continue
+            if form.instance.pk is None:
+                created.append(form.save(commit=False))
+            elif form.has_changed():
+                updated.append(form.save(commit=False))
+        return created, updated
+
+
+def bulk_vote_formset(uid, league, data=None):
+    """
+    Build the bulk rating formset for a user: a row for each vote they've already cast in the league, followed by a
+    row for each player in the league they still have to vote on. Every row must be filled in or skipped.
+    :param uid: ID of the currently logged in user.
+    :param league: League the votes are cast in.
+    :param data: (Optional) Submitted form data.
+    :return: Formset of BulkVoteForms
+    :rtype: BaseBulkVoteFormSet
+    """
+    queryset = Votes.objects.filter(league=league, user_id=uid).order_by('player')
+    unvoted = directory.get_unvoted_players(uid, league)
+
+    # Rows below min_num can't be left blank, so untouched default ratings still get saved
+    if data is None:
+        rows = len(queryset) + len(unvoted)
+    else:
+        try:
+            rows = int(data.get('form-TOTAL_FORMS', 0))
+        except ValueError:
+            rows = 0  # the formset reports the broken management form itself
+
+    formset_class = forms.modelformset_factory(Votes, form=BulkVoteForm, formset=BaseBulkVoteFormSet,
+                                               extra=0, min_num=rows)
+    return formset_class(data, queryset=queryset, initial=[{'player': name} for name in unvoted],
+                         form_kwargs={'valid_players': unvoted})
 
 
 class RosterForm(forms.ModelForm):
@@ -78,19 +195,23 @@ class RosterForm(forms.ModelForm):
     def __init__(self, *args, **kwargs):
         """
         Creates a dynamic drop down form field of registered users
+        :param league: League to pick players from.
         :param args:
         :param kwargs:
         """
 
+        league = kwargs.pop('league', None)
+
         super(RosterForm, self).__init__(*args, **kwargs)
 
-        users = User.objects.values()
-        first_names = users.values_list('first_name', flat=True)
-        last_names = users.values_list('last_name', flat=True)
+        human_names = directory.get_player_names(league)
 
-        human_names = []
-        for i in range(len(first_names)):
-            human_names.append(f"{first_names[i]} {last_names[i]}")
+        # Chosen from the cached profiles rather than a ModelChoiceField, which would query on render and on save
+        self.weight_profiles = {profile.pk: profile for profile in leagues.get_weight_profiles(league)}
+        if self.weight_profiles:
+            self.fields['weight_profile'] = forms.TypedChoiceField(
+                choices=[(profile.pk, profile.name) for profile in self.weight_profiles.values()], coerce=int,
+                initial=next(iter(self.weight_profiles)), required=False, label="Skill weights")
 
         USER_CHOICES = list(zip(human_names, human_names))
 
@@ -102,5 +223,11 @@ class RosterForm(forms.ModelForm):
 
         self.fields['players'] = forms.MultipleChoiceField(choices=USER_CHOICES, widget=forms.CheckboxSelectMultiple())
 
-
-
+    def save(self, commit=True):
+        roster = super(RosterForm, self).save(commit=False)
+        # Left blank, the league's default profile applies
+        selected = self.cleaned_data.get('weight_profile') or next(iter(self.weight_profiles), None)
+        roster.weight_profile = self.weight_profiles.get(selected)
+        if commit:
+            roster.save()
+        return roster
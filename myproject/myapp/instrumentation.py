@@ -0,0 +1,267 @@
+# instrumentation.py
+# Collects performance metrics for the request being served. The PerformanceMiddleware starts a collector for each
+# request, code along the way (the ORM, the team balancer) records into it, and the middleware logs the result.
+# Outside of a request (management commands, the shell) every hook is a no-op.
+
+import os
+import sys
+import threading
+import time
+import traceback
+from contextlib import contextmanager
+from functools import wraps
+
+from django.conf import settings
+
+
+_local = threading.local()
+
+_APP_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+_DATABASE_CACHE_MODULE = os.path.join('django', 'core', 'cache', 'backends', 'db.py')
+
+
+class QueryBudgetExceeded(Exception):
+    """
+    Raised when a view runs more queries than its declared budget while budgets are enforced.
+    """
+    pass
+
+
+class RequestMetrics:
+
+    def __init__(self):
+        """
+        Performance metrics for a single request.
+        """
+        self.started = time.perf_counter()
+        self.wall_ms = None
+        self.query_count = 0
+        self.query_ms = 0.0
+        self.counters = dict()  # e.g. splits evaluated, cache hits and misses
+        self.timings = dict()  # milliseconds spent in named sections, e.g. balancing
+        self.tags = dict()  # e.g. which solver balanced the teams
+        self.active_timers = set()
+        self.queries = None  # (sql, stack) of each query, only kept while query budgets are enforced
+
+    def finish(self):
+        self.wall_ms = (time.perf_counter() - self.started) * 1000
+
+    def as_dict(self):
+        """
+        Flatten the metrics into a single dictionary, ready for structured logging.
+        :return: Metrics keyed by name
+        :rtype: dict
+        """
+        record = {
+            "wall_ms": round(self.wall_ms or 0, 2),
+            "queries": self.query_count,
+            "query_ms": round(self.query_ms, 2),
+        }
+        record.update(self.counters)
+        record.update({f"{name}_ms": round(ms, 2) for name, ms in self.timings.items()})
+        record.update(self.tags)
+        return record
+
+    def server_timing(self):
+        """
+        Format the timings as a Server-Timing header value, so they show up in the browser's dev tools.
+        :return: Header value
+        :rtype: str
+        """
+        entries = [f"total;dur={self.wall_ms or 0:.1f}",
+                   f'db;dur={self.query_ms:.1f};desc="{self.query_count} queries"']
+        entries.extend(f"{name};dur={ms:.1f}" for name, ms in self.timings.items())
+        return ", ".join(entries)
+
+
+class QueryTimer:
+
+    def __init__(self, metrics):
+        """
+        Database execute wrapper that counts and times every query run while it's installed. Queries run by a database
+        cache are counted apart, as cache_queries, so query budgets mean the same whichever cache backend is
+        configured.
+        :param metrics: RequestMetrics to record into.
+        """
+        self.metrics = metrics
+        self.database_cache = any(cache['BACKEND'].endswith('.DatabaseCache') for cache in settings.CACHES.values())
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            if self.database_cache and _from_database_cache():
+                self.metrics.counters["cache_queries"] = self.metrics.counters.get("cache_queries", 0) + 1
+            else:
+                self.metrics.query_count += 1
+                self.metrics.query_ms += (time.perf_counter() - start) * 1000
+                if self.metrics.queries is not None:
+                    self.metrics.queries.append((sql, _project_stack()))
+
+
+def _from_database_cache():
+    """
+    :return: Whether the query being run comes from the database cache backend, including the savepoints it sets
+    :rtype: bool
+    """
+    frame = sys._getframe(2)
+    while frame is not None:
+        if frame.f_code.co_filename.endswith(_DATABASE_CACHE_MODULE):
+            return True
+        frame = frame.f_back
+    return False
+
+
+def _project_stack(limit=3):
+    """
+    Find where in our own code a query came from, skipping Django internals and this module.
+    :return: The innermost project frames, outermost first
+    :rtype: list
+    """
+    frames = [frame for frame in traceback.extract_stack()[:-2]
+              if frame.filename.startswith(_APP_ROOT) and "site-packages" not in frame.filename]
+    return frames[-limit:]
+
+
+def query_budget(max_queries):
+    """
+    Declare the most queries a view may run per request, counting everything from session and user lookups through
+    to template rendering. Budgets are only checked when settings.QUERY_BUDGETS_ENFORCED is on, e.g. in tests.
+    Class-based views can use method_decorator(query_budget(n), name='dispatch').
+    :param max_queries: Int. Query budget for the view.
+    """
+    def decorator(view_func):
+        view_func.query_budget = max_queries
+        return view_func
+    return decorator
+
+
+def check_query_budget(metrics, view_name):
+    """
+    Fail loudly if a request went over its view's query budget, listing each query and where it was run from.
+    :param metrics: RequestMetrics of the finished request.
+    :param view_name: Name of the view, for the error message.
+    :raises QueryBudgetExceeded: If the budget was exceeded.
+    """
+    budget = metrics.tags.get("query_budget")
+    if budget is None or metrics.query_count <= budget:
+        return
+
+    lines = [f"{view_name} ran {metrics.query_count} queries, over its budget of {budget}:"]
+    for number, (sql, stack) in enumerate(metrics.queries or [], start=1):
+        lines.append(f"{number}. {sql}")
+        lines.extend(f"     at {os.path.relpath(frame.filename, _APP_ROOT)}:{frame.lineno} in {frame.name}"
+                     for frame in stack)
+    raise QueryBudgetExceeded("\n".join(lines))
+
+
+def start():
+    """
+    Start collecting metrics for the current thread.
+    :return: The new collector
+    :rtype: RequestMetrics
+    """
+    _local.metrics = RequestMetrics()
+    return _local.metrics
+
+
+def stop():
+    """
+    Stop collecting metrics for the current thread.
+    :return: The finished collector, if one was running
+    :rtype: RequestMetrics
+    """
+    metrics = current()
+    _local.metrics = None
+    if metrics is not None:
+        metrics.finish()
+    return metrics
+
+
+def current():
+    return getattr(_local, "metrics", None)
+
+
+def incr(name, amount=1):
+    """
+    Add to a named counter of the current request.
+    """
+    metrics = current()
+    if metrics is not None:
+        metrics.counters[name] = metrics.counters.get(name, 0) + amount
+
+
+def tag(name, value):
+    """
+    Label the current request, e.g. with the solver that served it.
+    """
+    metrics = current()
+    if metrics is not None:
+        metrics.tags[name] = value
+
+
+@contextmanager
+def timer(name):
+    """
+    Time a section of code. Repeated sections with the same name add up, and a section nested inside itself (e.g.
+    by recursion) is only timed once.
+    :param name: Name of the section, as it appears in logs and the Server-Timing header.
+    """
+    metrics = current()
+    if metrics is None or name in metrics.active_timers:
+        yield
+        return
+
+    metrics.active_timers.add(name)
+    start_time = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = (time.perf_counter() - start_time) * 1000
+        metrics.timings[name] = metrics.timings.get(name, 0) + elapsed
+        metrics.active_timers.discard(name)
+
+
+class _NoLock:
+
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+def cached(cache, key, lock=None):
+    """
+    Drop-in replacement for cachetools.cached that also counts cache hits and misses for the current request.
+    :param cache: Mapping to store results in, e.g. a cachetools.TTLCache.
+    :param key: Function building the cache key from the call's arguments.
+    :param lock: (Optional) Lock held while reading and writing the cache, which cachetools caches need when they're
+        shared between threads. The function itself runs without it.
+    """
+    lock = lock or _NoLock()
+
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            k = key(*args, **kwargs)
+            try:
+                with lock:
+                    value = cache[k]
+            except KeyError:
+                incr("cache_misses")
+            else:
+                incr("cache_hits")
+                return value
+
+            value = func(*args, **kwargs)
+            try:
+                with lock:
+                    cache[k] = value
+            except ValueError:
+                pass  # value too large for the cache
+            return value
+        return wrapper
+    return decorator
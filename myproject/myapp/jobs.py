@@ -0,0 +1,162 @@
+# jobs.py
+# Balances big rosters in the background. Jobs are queued as BalancingJob rows, so they need no external queue and
+# survive restarts, and are run by a small pool of worker threads in the web process. A job is claimed with a
+# conditional update before it runs, so it's only ever run once, even if a `manage.py run_balancing_jobs` worker is
+# draining the same queue. A job whose worker went away mid-run, e.g. with an instance shut down, is requeued once it
+# has been running for longer than settings.BALANCING_JOB_TIMEOUT, and failed after MAX_ATTEMPTS tries.
+
+import json
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import F
+from django.utils import timezone
+
+from . import instrumentation
+from .models import BalancingJob, Roster
+
+
+logger = logging.getLogger(__name__)
+
+MAX_ATTEMPTS = 3
+
+_pool = None
+
+
+def is_big(players):
+    """
+    :param players: List of player names.
+    :return: Whether a roster takes too long to balance within a request
+    :rtype: bool
+    """
+    return len(players) >= getattr(settings, 'BALANCE_ASYNC_MIN_PLAYERS', 14)
+
+
+def get_pool():
+    global _pool
+    if _pool is None:
+        _pool = ThreadPoolExecutor(max_workers=getattr(settings, 'BALANCING_WORKERS', 2),
+                                   thread_name_prefix='balancing')
+    return _pool
+
+
+def enqueue(roster, players, weights=None):
+    """
+    Queue a roster for balancing. The job is handed to the worker pool once the current transaction commits, so
+    workers never look for a job that isn't there yet.
+    :param roster: The saved Roster.
+    :param players: List of player names.
+    :param weights: (Optional) Dictionary of skill name to weight.
+    :return: The queued job
+    :rtype: BalancingJob
+    """
+    job = BalancingJob.objects.create(league=roster.league, user=roster.user, roster=roster,
+                                      players=json.dumps(players), weights=json.dumps(weights) if weights else '')
+    transaction.on_commit(lambda: get_pool().submit(_work, job.pk))
+    instrumentation.incr("jobs_queued")
+    return job
+
+
+def claim(job_id):
+    """
+    :return: Whether this worker got the job, i.e. nobody else has started it
+    :rtype: bool
+    """
+    return BalancingJob.objects.filter(pk=job_id, status=BalancingJob.QUEUED).update(
+        status=BalancingJob.RUNNING, started_date=timezone.now(), attempts=F('attempts') + 1) == 1
+
+
+def is_stale(started_date):
+    """
+    :param started_date: When a running job was claimed.
+    :return: Whether it has been running for so long that its worker must have gone away
+    :rtype: bool
+    """
+    timeout = getattr(settings, 'BALANCING_JOB_TIMEOUT', 600)
+    return started_date is not None and timezone.now() - started_date > timedelta(seconds=timeout)
+
+
+def requeue_stale(job_id=None):
+    """
+    Put jobs left running by a worker that went away back in the queue, or fail them once they've been tried
+    MAX_ATTEMPTS times, in case it's the job that brings its worker down.
+    :param job_id: (Optional) ID of the only job to look at, defaults to every job.
+    :return: Number of jobs requeued
+    :rtype: int
+    """
+    cutoff = timezone.now() - timedelta(seconds=getattr(settings, 'BALANCING_JOB_TIMEOUT', 600))
+    stale = BalancingJob.objects.filter(status=BalancingJob.RUNNING, started_date__lt=cutoff)
+    if job_id is not None:
+        stale = stale.filter(pk=job_id)
+    failed = stale.filter(attempts__gte=MAX_ATTEMPTS).update(
+        status=BalancingJob.FAILED, error="The roster took too long to balance.", finished_date=timezone.now())
+    if failed:
+        logger.warning(f"Failed {failed} balancing job(s) that kept timing out")
+    return stale.update(status=BalancingJob.QUEUED, started_date=None)
+
+
+def resume_stale(job_id):
+    """
+    Requeue a job if its worker went away, and hand it to this process's pool.
+    :param job_id: ID of the job.
+    :return: Whether the job was requeued
+    :rtype: bool
+    """
+    if not requeue_stale(job_id):
+        return False
+    transaction.on_commit(lambda: get_pool().submit(_work, job_id))
+    return True
+
+
+def run_job(job_id):
+    """
+    Claim a job and balance its roster, storing the result or the error on the job.
+    :param job_id: ID of the job.
+    :return: Whether the job was run here
+    :rtype: bool
+    """
+    # Imported here so that workers only load the balancer once a request actually needs it
+    from .teamBalancer import balance_teams
+
+    if not claim(job_id):
+        return False
+
+    job = BalancingJob.objects.select_related('league').get(pk=job_id)
+    try:
+        teams = balance_teams(job.get_players(), team_size=None, threshold=0.5, max_cycles=5, league=job.league,
+                              weights=job.get_weights())
+    except Exception as e:
+        logger.exception(f"Balancing job {job_id} failed")
+        job.status, job.error = BalancingJob.FAILED, str(e)
+    else:
+        job.status, job.result = BalancingJob.DONE, json.dumps(teams or {})
+    job.finished_date = timezone.now()
+    job.save(update_fields=['status', 'result', 'error', 'finished_date'])
+    if job.status == BalancingJob.DONE and job.roster_id:
+        Roster.objects.filter(pk=job.roster_id).update(result=job.result)
+    return True
+
+
+def _work(job_id):
+    """
+    Run a job on a pool thread, which holds its own database connection.
+    """
+    try:
+        run_job(job_id)
+    finally:
+        connection.close()
+
+
+def run_queued_jobs():
+    """
+    Run every queued job, oldest first, in this thread, after requeueing jobs whose workers went away.
+    :return: Number of jobs run
+    :rtype: int
+    """
+    requeue_stale()
+    job_ids = BalancingJob.objects.filter(status=BalancingJob.QUEUED).order_by('created_date') \
+        .values_list('pk', flat=True)
+    return sum(run_job(job_id) for job_id in list(job_ids))
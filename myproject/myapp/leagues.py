@@ -0,0 +1,107 @@
+# leagues.py
+# Works out which league a request is for. Each user's leagues are cached, so picking the active league on every
+# request doesn't cost a query once the cache is warm.
+
+from django.core.cache import cache
+from django.db.models import Q
+
+from .models import League, Membership, WeightProfile
+from .versions import get_version
+
+
+SESSION_KEY = 'league_id'
+
+
+def get_default_league():
+    league, created = League.objects.get_or_create(slug=League.DEFAULT_SLUG, defaults={'name': 'Everyone'})
+    return league
+
+
+def get_user_leagues(uid):
+    """
+    :param uid: ID of the user.
+    :return: Leagues the user is a member of, oldest membership first
+    :rtype: list
+    """
+    key = f"myapp:leagues:{uid}:{get_version(f'leagues:{uid}')}"
+    leagues = cache.get(key)
+    if leagues is None:
+        leagues = list(League.objects.filter(memberships__user_id=uid).order_by('memberships__joined_date', 'pk'))
+        cache.set(key, leagues)
+    return leagues
+
+
+def join_league(user, league):
+    """
+    Add a user to a league, if they aren't a member already.
+    """
+    Membership.objects.get_or_create(league=league, user=user)
+
+
+def get_active_league(request):
+    """
+    Get the league the user is currently playing in: the one they last switched to, or else their first league.
+    Users who don't belong to any league yet (e.g. accounts created in the admin) join the default league. The league
+    is worked out once per request, however many times the view and context processors ask for it.
+    :return: The active league, or None for anonymous users
+    :rtype: League
+    """
+    if not request.user.is_authenticated:
+        return None
+    if not hasattr(request, '_active_league'):
+        request._active_league = _find_active_league(request)
+    return request._active_league
+
+
+def get_other_leagues(request):
+    """
+    :return: The user's leagues other than the active one, i.e. the ones they can switch to
+    :rtype: list
+    """
+    active = get_active_league(request)
+    if active is None:
+        return []
+    return [league for league in request._user_leagues if league != active]
+
+
+def _find_active_league(request):
+    leagues = request._user_leagues = get_user_leagues(request.user.id)
+    if not leagues:
+        join_league(request.user, get_default_league())
+        leagues = request._user_leagues = get_user_leagues(request.user.id)
+
+    league_id = request.session.get(SESSION_KEY)
+    for league in leagues:
+        if league.pk == league_id:
+            return league
+    return leagues[0]
+
+
+def switch_league(request, league):
+    """
+    Make a league the active one for the rest of the session.
+    :return: False if the user isn't a member of the league
+    :rtype: bool
+    """
+    leagues = get_user_leagues(request.user.id)
+    if league not in leagues:
+        return False
+    request.session[SESSION_KEY] = league.pk
+    request._user_leagues, request._active_league = leagues, league
+    return True
+
+
+def get_weight_profiles(league):
+    """
+    :param league: The league.
+    :return: Weight profiles the league can balance teams with, its default profile first
+    :rtype: list
+    """
+    key = f"myapp:weight_profiles:{league.pk}:{get_version('weight_profiles')}"
+    profiles = cache.get(key)
+    if profiles is None:
+        # League defaults beat global defaults, which beat everything else
+        profiles = sorted(WeightProfile.objects.filter(Q(league=league) | Q(league__isnull=True)).order_by('name'),
+                          key=lambda profile: (not profile.is_default, profile.league_id is None))
+        cache.set(key, profiles)
+    return profiles
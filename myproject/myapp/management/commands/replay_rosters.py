@@ -0,0 +1,81 @@
+import bisect
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from myapp import ratings
+from myapp.models import League, RatingsHistory, Roster
+
+
+class Command(BaseCommand):
+    help = ("Re-balance past rosters with the ratings history saved closest before each was published, and store the "
+            "new splits on the rosters next to the splits that were played.")
+
+    batch_size = 500
+
+    def add_arguments(self, parser):
+        parser.add_argument('--league', help="Slug of the league to replay, defaults to every league.")
+        parser.add_argument('--since', help="Only replay rosters published at or after this date and time.")
+        parser.add_argument('--until', help="Only replay rosters published before this date and time.")
+        parser.add_argument('--dry-run', action='store_true', help="Re-balance, but don't save the splits.")
+
+    def handle(self, *args, **options):
+        # Imported here so that workers only load the balancer once a command actually needs it
+        from myapp.teamBalancer import balance_teams
+
+        rosters = Roster.objects.filter(published_date__isnull=False).select_related('league', 'weight_profile')
+        histories = RatingsHistory.objects.all()
+        if options['league']:
+            try:
+                league = League.objects.get(slug=options['league'])
+            except League.DoesNotExist:
+                raise CommandError(f"No league called {options['league']!r}.")
+            rosters, histories = rosters.filter(league=league), histories.filter(league=league)
+        for option, lookup in (('since', 'published_date__gte'), ('until', 'published_date__lt')):
+            if options[option]:
+                when = parse_datetime(options[option])
+                if when is None:
+                    raise CommandError(f"Couldn't read --{option} {options[option]!r} as a date and time.")
+                if timezone.is_naive(when):
+                    when = timezone.make_aware(when)
+                rosters = rosters.filter(**{lookup: when})
+
+        # Every league's history dates up front, so finding a roster's history is a bisect rather than a query
+        timelines = {}
+        for history in histories.order_by('created_date').only('pk', 'league_id', 'created_date'):
+            dates, entries = timelines.setdefault(history.league_id, ([], []))
+            dates.append(history.created_date)
+            entries.append(history)
+
+        snapshots = {}  # history pk -> loaded snapshot; rosters are in date order, so only a few are live at once
+        replayed, skipped, batch = 0, 0, []
+        for roster in rosters.order_by('league_id', 'published_date').defer('result').iterator():
+            dates, entries = timelines.get(roster.league_id, ([], []))
+            index = bisect.bisect_right(dates, roster.published_date) - 1
+            if index < 0:
+                skipped += 1  # published before any history was saved
+                continue
+            history = entries[index]
+            if history.pk not in snapshots:
+                snapshots.clear()
+                snapshots[history.pk] = ratings.load_history(history)
+
+            weights = roster.weight_profile.as_weights() if roster.weight_profile else None
+            teams = balance_teams(roster.get_players(), team_size=None, threshold=0.5, max_cycles=5,
+                                  league=roster.league, weights=weights, snapshot=snapshots[history.pk])
+            roster.replayed_result, roster.ratings_history = json.dumps(teams or {}), history
+            batch.append(roster)
+            replayed += 1
+
+            if len(batch) >= self.batch_size:
+                self.save(batch, options['dry_run'])
+                batch = []
+        self.save(batch, options['dry_run'])
+
+        self.stdout.write(f"Replayed {replayed} roster(s), skipped {skipped} published before any ratings history.")
+
+    def save(self, rosters, dry_run):
+        if rosters and not dry_run:
+            Roster.objects.bulk_update(rosters, ['replayed_result', 'ratings_history'])
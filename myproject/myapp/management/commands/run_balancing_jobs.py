@@ -0,0 +1,22 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from myapp import jobs
+
+
+class Command(BaseCommand):
+    help = "Balance queued rosters, e.g. ones left behind when a web process restarted mid-job."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--watch', action='store_true', help="Keep polling the queue instead of exiting.")
+        parser.add_argument('--interval', type=float, default=2, help="Seconds between polls with --watch.")
+
+    def handle(self, *args, **options):
+        while True:
+            count = jobs.run_queued_jobs()
+            if count:
+                self.stdout.write(f"Balanced {count} roster(s).")
+            if not options['watch']:
+                return
+            time.sleep(options['interval'])
@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from myapp import ratings
+
+
+class Command(BaseCommand):
+    help = "Save every league's current ratings to the ratings history."
+
+    def handle(self, *args, **options):
+        histories = ratings.save_history(ratings.refresh())
+        self.stdout.write(f"Saved ratings history for {len(histories)} league(s).")
@@ -0,0 +1,179 @@
+import json
+import logging
+import mimetypes
+import os
+from contextlib import ExitStack
+
+from django.conf import settings
+from django.contrib.staticfiles import finders
+from django.contrib.staticfiles.storage import ManifestStaticFilesStorage
+from django.core.exceptions import SuspiciousFileOperation
+from django.db import connections
+from django.http import FileResponse, HttpResponseNotModified
+from django.utils._os import safe_join
+from django.utils.cache import patch_vary_headers
+from django.utils.http import http_date
+from django.views.static import was_modified_since
+
+from . import instrumentation, routers, versions
+
+
+logger = logging.getLogger("myapp.performance")
+
+
+class PerformanceMiddleware:
+    """
+    Records wall time, ORM queries and any balancer metrics for each request, and emits them as one structured log
+    line. With settings.PERFORMANCE_SERVER_TIMING turned on, the timings are also sent back in a Server-Timing header.
+    With settings.QUERY_BUDGETS_ENFORCED turned on, requests that go over their view's query_budget raise
+    QueryBudgetExceeded.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        metrics = instrumentation.start()
+        if getattr(settings, "QUERY_BUDGETS_ENFORCED", False):
+            metrics.queries = []
+        try:
+            with ExitStack() as stack:
+                for connection in connections.all():
+                    stack.enter_context(connection.execute_wrapper(instrumentation.QueryTimer(metrics)))
+                response = self.get_response(request)
+        finally:
+            instrumentation.stop()
+
+        match = request.resolver_match
+        record = {
+            "method": request.method,
+            "path": request.path,
+            "view": match.url_name if match else None,
+            "status": response.status_code,
+        }
+        record.update(metrics.as_dict())
+        logger.info(json.dumps(record))
+
+        if getattr(settings, "PERFORMANCE_SERVER_TIMING", False):
+            response["Server-Timing"] = metrics.server_timing()
+
+        if metrics.queries is not None:
+            instrumentation.check_query_budget(metrics, record["view"] or request.path)
+
+        return response
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        budget = getattr(view_func, "query_budget", None)
+        if budget is not None:
+            instrumentation.tag("query_budget", budget)
+
+
+class VersionsMiddleware:
+    """
+    Fetches each cache version at most once per request, however many cached lookups use it.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        with versions.remembered():
+            return self.get_response(request)
+
+
+class ReplicaStickinessMiddleware:
+    """
+    Pins reads to the primary database for requests that write, and for the same browser's requests in the next
+    settings.REPLICA_STICKY_SECONDS, so users see their own votes despite replication lag. The pin is kept in a
+    short-lived cookie rather than the session, so it costs no queries.
+    """
+
+    cookie_name = 'pin_primary'
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        writes = request.method not in ('GET', 'HEAD', 'OPTIONS', 'TRACE')
+        pinned = writes or self.cookie_name in request.COOKIES
+
+        with routers.pinned_to_primary(pinned):
+            response = self.get_response(request)
+
+        if writes:
+            response.set_cookie(self.cookie_name, '1', max_age=getattr(settings, 'REPLICA_STICKY_SECONDS', 10),
+                                httponly=True)
+
+        return response
+
+
+class StaticFilesMiddleware:
+    """
+    Serves collected static files from settings.STATIC_ROOT. Files with a content hash in their name (the ones listed
+    in the collectstatic manifest) never change, so browsers may cache them for a year without revalidating; anything
+    else is cached briefly and revalidated. Browsers that accept gzip get the precompressed copy written by
+    collectstatic, when there is one. Until collectstatic has run, files are found in the apps' static directories.
+    On App Engine the static handlers in app.yaml answer these requests before they reach the app.
+    """
+
+    hashed_max_age = 365 * 24 * 60 * 60
+    max_age = 5 * 60
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self._hashed_names = None
+
+    def __call__(self, request):
+        if request.method in ('GET', 'HEAD') and settings.STATIC_ROOT and request.path.startswith(settings.STATIC_URL):
+            response = self.serve(request, request.path[len(settings.STATIC_URL):])
+            if response is not None:
+                return response
+        return self.get_response(request)
+
+    @property
+    def hashed_names(self):
+        if self._hashed_names is None:
+            try:
+                with open(os.path.join(settings.STATIC_ROOT, ManifestStaticFilesStorage.manifest_name)) as f:
+                    self._hashed_names = set(json.load(f).get('paths', {}).values())
+            except (OSError, ValueError):
+                self._hashed_names = set()
+        return self._hashed_names
+
+    def serve(self, request, name):
+        """
+        :param request:
+        :param name: Path of the file, relative to STATIC_ROOT.
+        :return: The file, or None to let the app handle requests for files that don't exist
+        :rtype: HttpResponse
+        """
+        try:
+            path = safe_join(settings.STATIC_ROOT, name)
+        except SuspiciousFileOperation:  # e.g. ../ trying to get out of STATIC_ROOT
+            return None
+        if not os.path.isfile(path):
+            # Not collected yet, e.g. a local runserver, so look in the apps' own static directories
+            path = finders.find(name)
+            if not path:
+                return None
+
+        stat = os.stat(path)
+        if not was_modified_since(request.META.get('HTTP_IF_MODIFIED_SINCE'), stat.st_mtime, stat.st_size):
+            return HttpResponseNotModified()
+
+        content_type = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+        compressed = f"{path}.gz"
+        has_compressed = os.path.isfile(compressed)
+        gzipped = has_compressed and 'gzip' in request.META.get('HTTP_ACCEPT_ENCODING', '')
+
+        response = FileResponse(open(compressed if gzipped else path, 'rb'), content_type=content_type)
+        if gzipped:
+            response['Content-Encoding'] = 'gzip'
+        if has_compressed:
+            patch_vary_headers(response, ('Accept-Encoding',))
+        response['Last-Modified'] = http_date(stat.st_mtime)
+        if name in self.hashed_names:
+            response['Cache-Control'] = f"public, max-age={self.hashed_max_age}, immutable"
+        else:
+            response['Cache-Control'] = f"public, max-age={self.max_age}"
+        return response
@@ -0,0 +1,62 @@
+# Generated by Django 2.2 on 2026-10-19 02:37
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('myapp', '0009_auto_20190514_1200'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='League',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=100)),
+                ('slug', models.SlugField(unique=True)),
+                ('created_date', models.DateTimeField(default=django.utils.timezone.now)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='Membership',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('joined_date', models.DateTimeField(default=django.utils.timezone.now)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='membership',
+            name='league',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='memberships', to='myapp.League'),
+        ),
+        migrations.AddField(
+            model_name='membership',
+            name='user',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='memberships', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AddField(
+            model_name='league',
+            name='members',
+            field=models.ManyToManyField(related_name='leagues', through='myapp.Membership', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AddField(
+            model_name='roster',
+            name='league',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, to='myapp.League'),
+        ),
+        migrations.AddField(
+            model_name='votes',
+            name='league',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, to='myapp.League'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='membership',
+            unique_together={('league', 'user')},
+        ),
+    ]
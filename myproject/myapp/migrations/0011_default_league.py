@@ -0,0 +1,31 @@
+from django.conf import settings
+from django.db import migrations
+
+
+def create_default_league(apps, schema_editor):
+    """
+    Put everyone who registered before leagues existed into one default league, along with their votes and rosters.
+    """
+    League = apps.get_model('myapp', 'League')
+    Membership = apps.get_model('myapp', 'Membership')
+    Votes = apps.get_model('myapp', 'Votes')
+    Roster = apps.get_model('myapp', 'Roster')
+    User = apps.get_model(*settings.AUTH_USER_MODEL.split('.'))
+
+    league, created = League.objects.get_or_create(slug='default', defaults={'name': 'Everyone'})
+    Membership.objects.bulk_create(
+        Membership(league=league, user_id=user_id) for user_id in User.objects.values_list('pk', flat=True)
+    )
+    Votes.objects.filter(league__isnull=True).update(league=league)
+    Roster.objects.filter(league__isnull=True).update(league=league)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('myapp', '0010_leagues'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_default_league, migrations.RunPython.noop),
+    ]
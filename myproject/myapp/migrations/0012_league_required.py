@@ -0,0 +1,36 @@
+# Generated by Django 2.2 on 2026-10-19 02:37
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('myapp', '0011_default_league'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='roster',
+            name='league',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='myapp.League'),
+        ),
+        migrations.AlterField(
+            model_name='votes',
+            name='league',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='myapp.League'),
+        ),
+        migrations.AddIndex(
+            model_name='roster',
+            index=models.Index(fields=['league', 'published_date'], name='roster_league_published_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='votes',
+            index=models.Index(fields=['league', 'player'], name='votes_league_player_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='votes',
+            index=models.Index(fields=['league', 'user', 'published_date'], name='votes_league_user_idx'),
+        ),
+    ]
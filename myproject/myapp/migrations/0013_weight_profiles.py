@@ -0,0 +1,34 @@
+# Generated by Django 2.2 on 2026-10-19 02:41
+
+import django.core.validators
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('myapp', '0012_league_required'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='WeightProfile',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=100)),
+                ('attack', models.FloatField(default=1, validators=[django.core.validators.MinValueValidator(0)])),
+                ('defense', models.FloatField(default=1, validators=[django.core.validators.MinValueValidator(0)])),
+                ('possession', models.FloatField(default=1, validators=[django.core.validators.MinValueValidator(0)])),
+                ('stamina', models.FloatField(default=1, validators=[django.core.validators.MinValueValidator(0)])),
+                ('mobility', models.FloatField(default=1, validators=[django.core.validators.MinValueValidator(0)])),
+                ('is_default', models.BooleanField(default=False)),
+                ('league', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='weight_profiles', to='myapp.League')),
+            ],
+        ),
+        migrations.AddField(
+            model_name='roster',
+            name='weight_profile',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to='myapp.WeightProfile'),
+        ),
+    ]
@@ -0,0 +1,24 @@
+from django.db import migrations
+
+
+def create_standard_profile(apps, schema_editor):
+    """
+    Keep balancing teams the way it always has: attack, defense and possession count twice as much as stamina and
+    mobility, in every league.
+    """
+    WeightProfile = apps.get_model('myapp', 'WeightProfile')
+    WeightProfile.objects.get_or_create(
+        league=None, name='Standard',
+        defaults={'attack': 2, 'defense': 2, 'possession': 2, 'stamina': 1, 'mobility': 1, 'is_default': True},
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('myapp', '0013_weight_profiles'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_standard_profile, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,49 @@
+# Generated by Django 2.2 on 2026-10-19 02:54
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('myapp', '0015_balancing_jobs'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RatingsHistory',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created_date', models.DateTimeField(default=django.utils.timezone.now)),
+                ('league', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='ratings_history', to='myapp.League')),
+            ],
+            options={
+                'verbose_name_plural': 'ratings history',
+            },
+        ),
+        migrations.AddField(
+            model_name='roster',
+            name='result',
+            field=models.TextField(blank=True),
+        ),
+        migrations.CreateModel(
+            name='RatingsHistoryRow',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('player', models.CharField(max_length=200)),
+                ('ratings', models.BinaryField()),
+                ('history', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='rows', to='myapp.RatingsHistory')),
+            ],
+        ),
+        migrations.AddField(
+            model_name='roster',
+            name='ratings_history',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to='myapp.RatingsHistory'),
+        ),
+        migrations.AddIndex(
+            model_name='ratingshistory',
+            index=models.Index(fields=['league', 'created_date'], name='history_league_created_idx'),
+        ),
+    ]
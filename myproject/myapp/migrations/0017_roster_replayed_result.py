@@ -0,0 +1,18 @@
+# Generated by Django 2.2 on 2026-10-19 03:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('myapp', '0016_ratings_history'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='roster',
+            name='replayed_result',
+            field=models.TextField(blank=True),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 2.2 on 2026-10-19 03:08
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('myapp', '0018_cache_table'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='balancingjob',
+            name='attempts',
+            field=models.PositiveSmallIntegerField(default=0),
+        ),
+    ]
@@ -1,12 +1,77 @@
+import ast
+import json
+import struct
+
 from django.conf import settings
 from django.db import models
 from django.utils import timezone
 from django.contrib.auth.models import User
+from django.core.exceptions import ValidationError
 from django.core.validators import MinValueValidator, MaxValueValidator
 
 
+class League(models.Model):
+    """
+    A group of players who rate each other and play together. Votes and rosters belong to exactly one league, and
+    players only ever see, rate and get balanced against members of their own league.
+    """
+    name = models.CharField(max_length=100)
+    slug = models.SlugField(unique=True)
+    members = models.ManyToManyField(User, through='Membership', related_name='leagues')
+    created_date = models.DateTimeField(default=timezone.now)
+
+    DEFAULT_SLUG = 'default'
+
+    def __str__(self):
+        return self.name
+
+
+class Membership(models.Model):
+    league = models.ForeignKey(League, on_delete=models.CASCADE, related_name='memberships')
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='memberships')
+    joined_date = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        unique_together = (('league', 'user'),)
+
+    def __str__(self):
+        return f"{self.user} in {self.league}"
+
+
+class WeightProfile(models.Model):
+    """
+    How much each skill counts towards a player's overall score when balancing teams. Profiles without a league are
+    available to every league.
+    """
+    league = models.ForeignKey(League, on_delete=models.CASCADE, blank=True, null=True, related_name='weight_profiles')
+    name = models.CharField(max_length=100)
+    attack = models.FloatField(default=1, validators=[MinValueValidator(0)])
+    defense = models.FloatField(default=1, validators=[MinValueValidator(0)])
+    possession = models.FloatField(default=1, validators=[MinValueValidator(0)])
+    stamina = models.FloatField(default=1, validators=[MinValueValidator(0)])
+    mobility = models.FloatField(default=1, validators=[MinValueValidator(0)])
+    is_default = models.BooleanField(default=False)
+
+    SKILLS = ('attack', 'defense', 'possession', 'stamina', 'mobility')
+
+    def clean(self):
+        if sum(getattr(self, skill) for skill in self.SKILLS) <= 0:
+            raise ValidationError("At least one skill needs a weight above zero.")
+
+    def as_weights(self):
+        """
+        :return: Dictionary of skill name to weight
+        :rtype: dict
+        """
+        return {skill: getattr(self, skill) for skill in self.SKILLS}
+
+    def __str__(self):
+        return self.name
+
+
 class Votes(models.Model):
 
+    league = models.ForeignKey(League, on_delete=models.CASCADE)
     user = models.ForeignKey(User, on_delete=models.CASCADE)
     player = models.CharField(max_length=200)
     attack = models.IntegerField(default=5, validators=[MinValueValidator(1), MaxValueValidator(10)])
@@ -17,22 +82,155 @@ class Votes(models.Model):
     created_date = models.DateTimeField(default=timezone.now)
     published_date = models.DateTimeField(blank=True, null=True)
 
+    class Meta:
+        # Every query is scoped to one league, so indexes lead on it
+        indexes = [
+            models.Index(fields=['league', 'player'], name='votes_league_player_idx'),
+            models.Index(fields=['league', 'user', 'published_date'], name='votes_league_user_idx'),
+        ]
+
     def publish(self):
         self.published_date = timezone.now()
         self.save()
 
     def __str__(self):
-        return self.title
+        return f"{self.user} on {self.player}"
+
+
+class RatingsHistory(models.Model):
+    """
+    What every player's ratings in a league looked like at one point in time. Saved periodically from the in-memory
+    ratings snapshot, so past rosters can be re-balanced the way they would have been back then.
+    """
+    league = models.ForeignKey(League, on_delete=models.CASCADE, related_name='ratings_history')
+    created_date = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        verbose_name_plural = 'ratings history'
+        indexes = [
+            models.Index(fields=['league', 'created_date'], name='history_league_created_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.league} ratings on {self.created_date}"
+
+
+class RatingsHistoryRow(models.Model):
+    """
+    One player's ratings in a RatingsHistory, packed into a single binary value: average ratings per skill followed by
+    the variance of their ratings per skill, as little-endian 32-bit floats in SKILLS order.
+    """
+    history = models.ForeignKey(RatingsHistory, on_delete=models.CASCADE, related_name='rows')
+    player = models.CharField(max_length=200)
+    ratings = models.BinaryField()
+
+    SKILLS = WeightProfile.SKILLS
+    PACKING = struct.Struct(f"<{2 * len(SKILLS)}f")
+
+    @classmethod
+    def pack(cls, averages, variances):
+        return cls.PACKING.pack(*averages, *variances)
+
+    def unpack(self):
+        """
+        :return: (average rating per skill, variance per skill), both in SKILLS order
+        :rtype: tuple
+        """
+        values = self.PACKING.unpack(bytes(self.ratings))
+        return values[:len(self.SKILLS)], values[len(self.SKILLS):]
+
+    def __str__(self):
+        return f"{self.player} in {self.history}"
 
 
 class Roster(models.Model):
+    league = models.ForeignKey(League, on_delete=models.CASCADE)
     user = models.ForeignKey(User, on_delete=models.CASCADE)
     published_date = models.DateTimeField(blank=True, null=True)
     players = models.CharField(max_length=1000)
+    weight_profile = models.ForeignKey(WeightProfile, on_delete=models.SET_NULL, blank=True, null=True)
+    result = models.TextField(blank=True)  # JSON of the balance_teams result, i.e. the split that was played
+    # A re-balance with the ratings history from when the roster was published, kept apart from the played split
+    replayed_result = models.TextField(blank=True)
+    ratings_history = models.ForeignKey(RatingsHistory, on_delete=models.SET_NULL, blank=True, null=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['league', 'published_date'], name='roster_league_published_idx'),
+        ]
 
     def publish(self):
         self.published_date = timezone.now()
         self.save()
 
+    def get_players(self):
+        """
+        :return: Names of the players on the roster, which are saved as the text of a Python list
+        :rtype: list
+        """
+        try:
+            players = ast.literal_eval(self.players)
+        except (ValueError, SyntaxError):
+            return []
+        return [str(player) for player in players] if isinstance(players, (list, tuple)) else []
+
+    def get_result(self):
+        return json.loads(self.result) if self.result else None
+
+    def get_replayed_result(self):
+        return json.loads(self.replayed_result) if self.replayed_result else None
+
+    def __str__(self):
+        return f"Roster by {self.user} on {self.published_date}"
+
+
+class BalancingJob(models.Model):
+    """
+    A roster waiting to be, or already, balanced in the background. Big rosters take too long to balance within a
+    request, so they're queued here and picked up by a worker; see myapp/jobs.py.
+    """
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    STATUS_CHOICES = (
+        (QUEUED, 'Queued'),
+        (RUNNING, 'Running'),
+        (DONE, 'Done'),
+        (FAILED, 'Failed'),
+    )
+
+    league = models.ForeignKey(League, on_delete=models.CASCADE)
+    user = models.ForeignKey(User, on_delete=models.CASCADE)
+    roster = models.ForeignKey(Roster, on_delete=models.SET_NULL, blank=True, null=True)
+    players = models.TextField()  # JSON list of player names
+    weights = models.TextField(blank=True)  # JSON dictionary of skill name to weight, or blank for the default weights
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=QUEUED)
+    result = models.TextField(blank=True)  # JSON of the balance_teams result
+    error = models.TextField(blank=True)
+    created_date = models.DateTimeField(default=timezone.now)
+    started_date = models.DateTimeField(blank=True, null=True)
+    finished_date = models.DateTimeField(blank=True, null=True)
+    attempts = models.PositiveSmallIntegerField(default=0)  # times a worker has claimed the job
+
+    class Meta:
+        # Workers pick the oldest queued job first
+        indexes = [
+            models.Index(fields=['status', 'created_date'], name='job_status_created_idx'),
+        ]
+
+    def get_players(self):
+        return json.loads(self.players)
+
+    def get_weights(self):
+        return json.loads(self.weights) if self.weights else None
+
+    def get_result(self):
+        return json.loads(self.result) if self.result else None
+
+    @property
+    def finished(self):
+        return self.status in (self.DONE, self.FAILED)
+
     def __str__(self):
-        return self.title
+        return f"Balancing job {self.pk} ({self.status})"
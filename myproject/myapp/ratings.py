@@ -0,0 +1,395 @@
+# ratings.py
+# In-memory snapshot of every player's average skill ratings, per league. The snapshot is built with one aggregate
+# query over Votes, preloaded when the app starts and kept fresh by a background thread, so balancing teams doesn't
+# need a database round trip. A new snapshot is built on the side and swapped in with a single assignment, so readers
+# always see either the old snapshot or the new one in full. Each league's ratings carry their own version, so a vote
+# only has its own league rebuilt, with an aggregate over that league's votes.
+# Overall scores under a set of skill weights are computed for a whole league at once, as one matrix-vector product
+# over the league's skill table, and kept on the snapshot they were computed from. Swapping in a new snapshot therefore
+# drops them along with the ratings they came from.
+# Every RATINGS_HISTORY_INTERVAL seconds the refresher also saves the snapshot to the database as RatingsHistory, so
+# past rosters can be re-balanced "as of" the ratings at the time.
+
+import logging
+import threading
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import DatabaseError, connection, transaction
+from django.db.models import Avg, Count, ExpressionWrapper, F, FloatField, Value
+from django.utils import timezone
+
+from . import routers
+from .models import League, RatingsHistory, RatingsHistoryRow, Votes
+from .versions import get_version, get_versions
+
+
+logger = logging.getLogger(__name__)
+
+SKILLS = ("attack", "defense", "possession", "stamina", "mobility")
+
+DEFAULT_SCORE = 5  # for players nobody has voted on yet
+DEFAULT_VARIANCE = 4  # how far an unrated player's ratings are assumed to spread, i.e. a standard deviation of 2
+
+
+class RatingsSnapshot:
+
+    def __init__(self, skills, versions, variances=None):
+        """
+        Average skill ratings of every player, as of each league's ratings version.
+        :param skills: Dictionary of league ID to a dictionary of player name to a tuple of average ratings, in SKILLS
+            order.
+        :param versions: Dictionary of league ID to the ratings version the league's ratings were built from.
+        :param variances: (Optional) Same shape as skills, holding the variance of each player's ratings per skill.
+        """
+        self.skills = skills
+        self.variances = variances or {}
+        self.versions = versions
+        self.built_at = time.time()
+        self._matrices = {}
+        self._weighted = {}
+
+    def for_league(self, league_id):
+        """
+        :param league_id: ID of the league.
+        :return: Dictionary of player name to average rating for each skill, in SKILLS order
+        :rtype: dict
+        """
+        return self.skills.get(league_id, {})
+
+    def get(self, player, league_id):
+        """
+        :param player: Player name.
+        :param league_id: ID of the league the player was rated in.
+        :return: Average rating for each skill, in SKILLS order, or None if nobody has voted on the player
+        :rtype: tuple
+        """
+        return self.for_league(league_id).get(player)
+
+    def skill_matrix(self, league_id, variances=False):
+        """
+        :param league_id: ID of the league.
+        :param variances: Whether to return rating variances instead of average ratings.
+        :return: (player names, array with a row of average ratings per player and a column per skill, in SKILLS order)
+        :rtype: tuple
+        """
+        key = (league_id, variances)
+        matrix = self._matrices.get(key)
+        if matrix is None:
+            import numpy as np  # only needed once teams are balanced, so kept off the import path of every worker
+
+            players = (self.variances if variances else self.skills).get(league_id, {})
+            names = list(players)
+            values = np.array([players[name] for name in names], dtype=float).reshape(len(names), len(SKILLS))
+            matrix = self._matrices[key] = (names, values)
+        return matrix
+
+    def weighted_scores(self, league_id, weights):
+        """
+        Overall score of every rated player in a league: the weighted mean of their average ratings.
+        :param league_id: ID of the league.
+        :param weights: Dictionary of skill name to weight.
+        :return: Dictionary of player name to overall score
+        :rtype: dict
+        """
+        key = (league_id, tuple(float(weights[skill]) for skill in SKILLS))
+        scores = self._weighted.get(key)
+        if scores is None:
+            import numpy as np
+
+            names, values = self.skill_matrix(league_id)
+            vector = np.array(key[1])
+            scores = self._weighted[key] = dict(zip(names, (values @ vector / vector.sum()).tolist()))
+        return scores
+
+    def weighted_variances(self, league_id, weights):
+        """
+        Variance of every rated player's overall score across the votes cast on them, treating skills as independent:
+        the weighted sum of the per-skill variances, with the weights squared.
+        :param league_id: ID of the league.
+        :param weights: Dictionary of skill name to weight.
+        :return: Dictionary of player name to variance of their overall score
+        :rtype: dict
+        """
+        key = (league_id, tuple(float(weights[skill]) for skill in SKILLS), 'variance')
+        variances = self._weighted.get(key)
+        if variances is None:
+            import numpy as np
+
+            names, values = self.skill_matrix(league_id, variances=True)
+            vector = np.array(key[1])
+            variances = self._weighted[key] = dict(zip(names, (values @ vector ** 2 / vector.sum() ** 2).tolist()))
+        return variances
+
+    def with_league(self, league_id, skills, variances, version):
+        """
+        Copy of the snapshot with one league's ratings replaced. Scores already computed for the other leagues are
+        kept, and so is the build time, which only full rebuilds move on.
+        :param league_id: ID of the league.
+        :param skills: Dictionary of player name to a tuple of average ratings, in SKILLS order.
+        :param variances: Same shape as skills, holding variances.
+        :param version: The ratings version the league's ratings were built from.
+        :return: A new snapshot
+        :rtype: RatingsSnapshot
+        """
+        snapshot = RatingsSnapshot({**self.skills, league_id: skills}, {**self.versions, league_id: version},
+                                   {**self.variances, league_id: variances})
+        snapshot.built_at = self.built_at
+        snapshot._matrices = {key: value for key, value in self._matrices.items() if key[0] != league_id}
+        snapshot._weighted = {key: value for key, value in self._weighted.items() if key[0] != league_id}
+        return snapshot
+
+    def stale_leagues(self, league_ids=None):
+        """
+        :param league_ids: (Optional) IDs of the leagues to check, defaults to every league in the snapshot.
+        :return: IDs of the leagues whose ratings have changed since they were built, or that the snapshot is missing
+        :rtype: list
+        """
+        league_ids = list(self.versions if league_ids is None else league_ids)
+        current = get_versions([f'ratings:{league_id}' for league_id in league_ids])
+        return [league_id for league_id in league_ids
+                if self.versions.get(league_id) != current[f'ratings:{league_id}']]
+
+    def __len__(self):
+        return sum(len(players) for players in self.skills.values())
+
+
+_snapshot = None
+_build_lock = threading.Lock()
+_refresher = None
+_changed = threading.Event()
+_changed_lock = threading.Lock()
+_changed_leagues = set()  # leagues voted in by this process since the refresher last looked
+
+
+def _aggregate(votes):
+    """
+    :param votes: Votes to aggregate.
+    :return: (skills, variances) dictionaries, shaped like a RatingsSnapshot's
+    :rtype: tuple
+    """
+    # Variances come from the mean of the squares, which every database can average, unlike VARIANCE()
+    rows = votes.order_by().values('league_id', 'player').annotate(
+        **{f"avg_{skill}": Avg(skill) for skill in SKILLS},
+        **{f"sq_{skill}": Avg(F(skill) * F(skill), output_field=FloatField()) for skill in SKILLS})
+
+    skills, variances = {}, {}
+    for row in rows:
+        averages = tuple(row[f"avg_{skill}"] for skill in SKILLS)
+        skills.setdefault(row['league_id'], {})[row['player']] = averages
+        variances.setdefault(row['league_id'], {})[row['player']] = tuple(
+            max(row[f"sq_{skill}"] - average ** 2, 0) for skill, average in zip(SKILLS, averages))
+    return skills, variances
+
+
+def build_snapshot():
+    """
+    Build a snapshot of every league from the database, with a single aggregate query over Votes.
+    :return: A new snapshot
+    :rtype: RatingsSnapshot
+    """
+    league_ids = list(League.objects.values_list('pk', flat=True))
+    # Read the versions first: a vote landing mid-build bumps them again, so the next refresh picks the vote up
+    versions = get_versions([f'ratings:{league_id}' for league_id in league_ids])
+    skills, variances = _aggregate(Votes.objects.all())
+    return RatingsSnapshot(skills, {league_id: versions[f'ratings:{league_id}'] for league_id in league_ids},
+                           variances)
+
+
+def build_league(snapshot, league_id):
+    """
+    Rebuild one league's ratings, with an aggregate query over that league's votes only.
+    :param snapshot: Snapshot holding the other leagues' ratings.
+    :param league_id: ID of the league.
+    :return: A new snapshot
+    :rtype: RatingsSnapshot
+    """
+    version = get_version(f'ratings:{league_id}')
+    skills, variances = _aggregate(Votes.objects.filter(league_id=league_id))
+    return snapshot.with_league(league_id, skills.get(league_id, {}), variances.get(league_id, {}), version)
+
+
+def refresh(primary=False, league_ids=None):
+    """
+    Rebuild the snapshot and swap it in.
+    :param primary: Whether to read the primary database rather than the ratings replica, e.g. because a vote has just
+        changed the ratings and the replica may not have it yet.
+    :param league_ids: (Optional) IDs of the only leagues to rebuild, e.g. the ones a vote has changed. Defaults to
+        rebuilding every league.
+    :return: The new snapshot
+    :rtype: RatingsSnapshot
+    """
+    global _snapshot
+    with _build_lock, routers.pinned_to_primary(primary):
+        if league_ids is None or _snapshot is None:
+            _snapshot = build_snapshot()
+        else:
+            for league_id in league_ids:
+                _snapshot = build_league(_snapshot, league_id)
+    logger.debug(f"Ratings snapshot refreshed: {len(_snapshot)} players, leagues {league_ids or 'all'}")
+    return _snapshot
+
+
+def get_snapshot(league_id=None):
+    """
+    Get the current snapshot. While the background refresher runs this never touches the database after the first
+    build; without it (e.g. in tests) leagues whose ratings version has moved on are rebuilt on read.
+    :param league_id: (Optional) ID of the only league the caller needs up to date, defaults to every league.
+    :return: The current snapshot
+    :rtype: RatingsSnapshot
+    """
+    snapshot = _snapshot
+    if snapshot is None:
+        return refresh()
+    if _refresher is None:
+        stale = snapshot.stale_leagues(None if league_id is None else [league_id])
+        if stale:
+            return refresh(primary=True, league_ids=stale)
+    return snapshot
+
+
+def player_ratings(league, weights=None):
+    """
+    Aggregate query for every player rated in a league: how many votes they've had, their average rating per skill
+    (as avg_<skill>) and their overall score. Unlike the snapshot this reads the database, for pages and exports that
+    need more than the balancer does.
+    :param league: The league.
+    :param weights: (Optional) Dictionary of skill name to weight for the overall score, defaults to equal weights.
+    :return: Dictionaries, ordered by player name along the (league, player) index
+    :rtype: QuerySet
+    """
+    weights = weights or {skill: 1 for skill in SKILLS}
+    overall = sum(Value(weights[skill]) * Avg(skill) for skill in SKILLS) / Value(sum(weights.values()))
+    return (Votes.objects.filter(league=league).order_by('player').values('player')
+            .annotate(votes=Count('pk'), **{f"avg_{skill}": Avg(skill) for skill in SKILLS},
+                      overall=ExpressionWrapper(overall, output_field=FloatField())))
+
+
+def save_history(snapshot=None):
+    """
+    Save a snapshot to the database, as one RatingsHistory per league with a packed row per player.
+    :param snapshot: (Optional) The snapshot to save, defaults to the current one.
+    :return: The saved histories
+    :rtype: list
+    """
+    snapshot = snapshot or get_snapshot()
+    histories = []
+    with transaction.atomic():
+        for league_id, players in snapshot.skills.items():
+            history = RatingsHistory.objects.create(league_id=league_id)
+            variances = snapshot.variances.get(league_id, {})
+            RatingsHistoryRow.objects.bulk_create(
+                (RatingsHistoryRow(history=history, player=player,
+                                   ratings=RatingsHistoryRow.pack(averages, variances.get(player, (0,) * len(SKILLS))))
+                 for player, averages in players.items()),
+                batch_size=500,
+            )
+            histories.append(history)
+    logger.info(f"Saved ratings history for {len(histories)} leagues")
+    return histories
+
+
+def load_history(history):
+    """
+    Load a saved history back into a snapshot, to balance teams with ratings as they were back then.
+    :param history: RatingsHistory to load.
+    :return: Snapshot holding the history's league
+    :rtype: RatingsSnapshot
+    """
+    skills, variances = {}, {}
+    for row in RatingsHistoryRow.objects.filter(history=history).only('player', 'ratings'):
+        skills[row.player], variances[row.player] = row.unpack()
+    return RatingsSnapshot({history.league_id: skills}, {history.league_id: f"history:{history.pk}"},
+                           {history.league_id: variances})
+
+
+def history_as_of(league, when):
+    """
+    :param league: The league.
+    :param when: Datetime.
+    :return: The league's latest history saved at or before a point in time, or None if there isn't one
+    :rtype: RatingsHistory
+    """
+    return RatingsHistory.objects.filter(league=league, created_date__lte=when).order_by('-created_date').first()
+
+
+def ratings_changed(league_id):
+    """
+    Wake the background refresher early, e.g. after a vote has been saved in this process.
+    :param league_id: ID of the league whose ratings changed, which the refresher checks even if it's new since the
+        last full rebuild.
+    """
+    with _changed_lock:
+        _changed_leagues.add(league_id)
+    _changed.set()
+
+
+class SnapshotRefresher(threading.Thread):
+
+    def __init__(self, interval, poll):
+        """
+        Background thread keeping the snapshot fresh.
+        :param interval: Seconds between full rebuilds, catching votes saved by other instances.
+        :param poll: Seconds between checks of the leagues' ratings versions.
+        """
+        super(SnapshotRefresher, self).__init__(name="ratings-snapshot", daemon=True)
+        self.interval = interval
+        self.poll = poll
+        self.history_interval = getattr(settings, 'RATINGS_HISTORY_INTERVAL', 0)
+        self.history_due = None  # when the next history should be saved, once the latest one has been looked up
+
+    def save_history_if_due(self):
+        """
+        Save the snapshot as history if the latest saved history is old enough. Other instances save history too, so
+        the database is checked again before saving.
+        """
+        now = timezone.now()
+        if not self.history_interval or (self.history_due is not None and now < self.history_due):
+            return
+        latest = RatingsHistory.objects.order_by('-created_date').values_list('created_date', flat=True).first()
+        if latest is None or (now - latest).total_seconds() >= self.history_interval:
+            save_history(_snapshot)
+            latest = now
+        self.history_due = latest + timedelta(seconds=self.history_interval)
+
+    def refresh_if_stale(self):
+        """
+        Rebuild the leagues whose ratings a vote has changed since they were built, reading the primary so the vote is
+        in them, or the whole snapshot if it's older than the interval, reading the replica. Leagues created since the
+        last full rebuild are only checked once this process has seen a vote in them.
+        """
+        with _changed_lock:
+            changed = set(_changed_leagues)
+        snapshot = _snapshot
+        stale = snapshot.stale_leagues(set(snapshot.versions) | changed) if snapshot is not None else None
+        if stale:
+            refresh(primary=True, league_ids=stale)
+        elif snapshot is None or time.time() - snapshot.built_at >= self.interval:
+            refresh()
+        with _changed_lock:
+            _changed_leagues.difference_update(changed)  # only once they're rebuilt, so a failed build tries again
+
+    def run(self):
+        while True:
+            try:
+                self.refresh_if_stale()
+                self.save_history_if_due()
+            except DatabaseError as e:
+                logger.warning(f"Couldn't refresh the ratings snapshot, will retry: {e}")
+                connection.close()
+
+            _changed.wait(self.poll)
+            _changed.clear()
+
+
+def start_refresher():
+    """
+    Start the background refresher, which builds the first snapshot straight away. Safe to call more than once.
+    """
+    global _refresher
+    if _refresher is not None:
+        return
+    _refresher = SnapshotRefresher(interval=getattr(settings, 'RATINGS_SNAPSHOT_INTERVAL', 300),
+                                   poll=getattr(settings, 'RATINGS_SNAPSHOT_POLL', 5))
+    _refresher.start()
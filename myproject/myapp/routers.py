@@ -0,0 +1,52 @@
+# routers.py
+# Database routing for a read replica. Rating reads (the Votes aggregations behind balancing, vote lists and forms)
+# go to settings.RATINGS_READ_DATABASE; all writes, and reads of everything else, go to the primary ('default').
+#
+# Replicas lag behind the primary, so a session that has just written something (voted, edited a vote, submitted a
+# roster) is pinned to the primary for settings.REPLICA_STICKY_SECONDS and reads its own writes.
+# See ReplicaStickinessMiddleware for where the pin is set.
+
+import threading
+from contextlib import contextmanager
+
+from django.conf import settings
+
+
+PRIMARY = 'default'
+
+# Models whose reads may be served by the replica, by model name
+RATING_MODELS = {'votes'}
+
+_local = threading.local()
+
+
+def is_pinned():
+    return getattr(_local, 'pinned', False)
+
+
+@contextmanager
+def pinned_to_primary(pinned=True):
+    """
+    Route every read in the block to the primary.
+    :param pinned: Whether to pin, so callers can decide at runtime.
+    """
+    previous = is_pinned()
+    _local.pinned = previous or pinned
+    try:
+        yield
+    finally:
+        _local.pinned = previous
+
+
+class RatingsReplicaRouter:
+
+    def db_for_read(self, model, **hints):
+        if model._meta.app_label == 'myapp' and model._meta.model_name in RATING_MODELS and not is_pinned():
+            return getattr(settings, 'RATINGS_READ_DATABASE', PRIMARY)
+        return PRIMARY
+
+    def db_for_write(self, model, **hints):
+        return PRIMARY
+
+    def allow_relation(self, obj1, obj2, **hints):
+        return True  # the replica holds the same rows as the primary
@@ -0,0 +1,48 @@
+from django.contrib.auth.models import User
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+
+from . import ratings
+from .models import Membership, Votes, WeightProfile
+from .versions import bump_version
+
+
+@receiver(post_save, sender=User)
+def user_changed(sender, instance, created=False, update_fields=None, **kwargs):
+    """
+    Refresh the directories of the leagues a player is in when they change their name. New players only show up once
+    they join a league, and players who leave drop out as their memberships are deleted. Logging in only touches
+    last_login, which the directory doesn't care about.
+    """
+    if created or (update_fields is not None and set(update_fields) <= {'last_login'}):
+        return
+    for league_id in Membership.objects.filter(user_id=instance.pk).values_list('league_id', flat=True):
+        bump_version(f'directory:{league_id}')
+
+
+@receiver([post_save, post_delete], sender=Membership)
+def membership_changed(sender, instance, **kwargs):
+    bump_version(f'leagues:{instance.user_id}')
+    bump_version(f'directory:{instance.league_id}')
+
+
+@receiver([post_save, post_delete], sender=WeightProfile)
+def weight_profile_changed(sender, instance, **kwargs):
+    bump_version('weight_profiles')
+
+
+def votes_changed(user_id, league_id):
+    """
+    Invalidate caches built from a user's votes in a league. Bulk writes don't send model signals, so they call this
+    once per batch themselves.
+    :param user_id: ID of the user whose votes changed.
+    :param league_id: ID of the league the votes were cast in.
+    """
+    bump_version(f'votes:{user_id}')
+    bump_version(f'ratings:{league_id}')
+    ratings.ratings_changed(league_id)
+
+
+@receiver([post_save, post_delete], sender=Votes)
+def vote_changed(sender, instance, **kwargs):
+    votes_changed(instance.user_id, instance.league_id)
@@ -0,0 +1,77 @@
+# storage.py
+# Static files storage for collectstatic. On top of the content-hashed names and manifest from
+# ManifestStaticFilesStorage, it writes a gzipped copy next to every hashed file that compresses well, so the
+# static files middleware can send it as-is to browsers that accept gzip instead of compressing on every request.
+
+import gzip
+import io
+import logging
+import os
+
+from django.contrib.staticfiles.storage import ManifestStaticFilesStorage
+from django.core.files.base import ContentFile
+
+
+logger = logging.getLogger(__name__)
+
+
+# Images other than icons and SVGs are compressed already
+COMPRESSIBLE_EXTENSIONS = {'.css', '.js', '.map', '.json', '.svg', '.ico', '.txt', '.html', '.xml', '.eot', '.ttf',
+                           '.otf'}
+
+MIN_COMPRESS_SIZE = 256  # bytes; smaller files barely shrink and cost an extra file lookup
+
+
+class CompressedManifestStaticFilesStorage(ManifestStaticFilesStorage):
+    """
+    Unlike ManifestStaticFilesStorage, files missing from the manifest (e.g. before collectstatic has run at all) keep
+    their plain names instead of failing every page that links to them.
+    """
+
+    manifest_strict = False
+
+    def stored_name(self, name):
+        try:
+            return super(CompressedManifestStaticFilesStorage, self).stored_name(name)
+        except ValueError:  # not collected, so there's no file to hash either
+            logger.warning(f"{name} isn't in the static files manifest, run collectstatic")
+            return name
+
+    def post_process(self, paths, dry_run=False, **options):
+        yield from super(CompressedManifestStaticFilesStorage, self).post_process(paths, dry_run, **options)
+
+        if dry_run:
+            return
+        for hashed_name in set(self.hashed_files.values()):
+            self.compress(hashed_name)
+
+    def compress(self, name):
+        """
+        Write a gzipped copy of a file, as name.gz, if it's worth compressing. Hashed files never change, so an
+        existing copy is left alone.
+        :param name: Name of the file in the storage.
+        :return: Name of the gzipped copy, or None if the file isn't worth compressing
+        :rtype: str
+        """
+        if os.path.splitext(name)[1].lower() not in COMPRESSIBLE_EXTENSIONS:
+            return None
+
+        compressed_name = f"{name}.gz"
+        if self.exists(compressed_name):
+            return compressed_name
+
+        with self.open(name) as original:
+            content = original.read()
+        if len(content) < MIN_COMPRESS_SIZE:
+            return None
+
+        # A fixed mtime keeps the output identical between builds. gzip.compress() only takes one from Python 3.8.
+        buffer = io.BytesIO()
+        with gzip.GzipFile(filename='', mode='wb', compresslevel=9, fileobj=buffer, mtime=0) as f:
+            f.write(content)
+        compressed = buffer.getvalue()
+        if len(compressed) >= len(content):
+            return None
+
+        self._save(compressed_name, ContentFile(compressed))
+        return compressed_name
@@ -1,25 +1,27 @@
 # balanceTeams.py
 # Creates two random teams from a list players, balanced according to how they're each rated against particular skills
 
-from .models import Votes
+from . import instrumentation, ratings
 
-import pandas as pd
-import numpy as np
-from itertools import combinations
 import logging
 import math
+import threading
 from random import choice, randint
 import operator
 
-from cachetools import cached, TTLCache
+from cachetools import TTLCache
 from cachetools.keys import hashkey
 from functools import partial
 
 
 cache = TTLCache(maxsize=100, ttl=300)
+# Requests and the background balancing workers share the cache, and cachetools caches aren't thread-safe
+cache_lock = threading.Lock()
 
+logger = logging.getLogger(__name__)
 
-logging.getLogger().setLevel(logging.INFO)  # default root logger to info level, instead of warning
+# Number of matches simulated to estimate each split's win probability
+SIMULATIONS = 10000
 
 # Set skill names and importance of each skill here
 WEIGHTS = dict({
@@ -33,65 +35,89 @@ WEIGHTS = dict({
 
 class Player:
 
-    def __init__(self, name):
+    def __init__(self, name, league=None, weights=None, snapshot=None):
         """
         Defines a football player class.
         :param name: The player's name, str.
+        :param league: (Optional) League the player is rated in. Only votes cast in this league count.
+        :param weights: (Optional) Dictionary of skill name to weight, used for the player's overall score. Defaults to
+            WEIGHTS.
+        :param snapshot: (Optional) RatingsSnapshot to take the player's ratings from, e.g. one loaded from ratings
+            history. Defaults to the current ratings.
         """
         self.name = name
+        self.league_id = league.pk if league is not None else None
+        self.weights = weights or WEIGHTS
         self.skill_names = list(WEIGHTS.keys())
+        self.snapshot = snapshot
+
+    def get_snapshot(self):
+        return self.snapshot or ratings.get_snapshot(self.league_id)
 
     def get_name(self):
         return self.name
 
-    @cached(cache=cache, key=partial(hashkey, 'get_votes'))
-    def get_votes(self):
-        attributes = ['player'] + self.skill_names
-        player_votes = Votes.objects.filter(player=self.name).values_list(
-            *attributes
-        )
-        return pd.DataFrame(player_votes, columns=attributes)
-
-    @cached(cache=cache, key=partial(hashkey, 'get_skill_scores'))
+    @instrumentation.cached(cache=cache, key=partial(hashkey, 'get_skill_scores'), lock=cache_lock)
     def get_skill_scores(self, skills="all"):
         """
-        Calculate score per skill
-        :param skills: Skills to calculate average scores for (not yet implemented)
-        :type skills: list
+        Calculate score per skill, from the in-memory ratings snapshot
+        :param skills: Skills to calculate average scores for, default is 'all'
+        :type skills: str or tuple
         :return: Average scores for each skill
-        :rtype: pandas.core.series.Series
+        :rtype: dict
         """
-        votes = self.get_votes()
+        averages = self.get_snapshot().get(self.name, self.league_id)
+        skill_names = self.skill_names if skills == "all" else list(skills)
 
-        if votes.empty:
-            logging.warning(f"{self.name} has no votes. Defaulting to skill scores of 5.")
-            return pd.Series([5, 5, 5, 5, 5], index=self.skill_names)
-        elif skills == "all":
-            return votes[votes.columns[~votes.columns.isin(["name", "player"])]].apply(np.mean)
-        else:
-            return votes[skills].apply(np.mean)
+        if averages is None:
+            logger.warning(f"{self.name} has no votes. Defaulting to skill scores of {ratings.DEFAULT_SCORE}.")
+            return {skill: ratings.DEFAULT_SCORE for skill in skill_names}
+
+        return {skill: averages[ratings.SKILLS.index(skill)] for skill in skill_names}
 
-    @cached(cache=cache, key=partial(hashkey, 'get_overall_score'))
+    @instrumentation.cached(cache=cache, key=partial(hashkey, 'get_overall_score'), lock=cache_lock)
     def get_overall_score(self, skills="all", weights=WEIGHTS):
         """
         Calculate overall skill level of the player
-        :param weights: Relative importance of each skill
+        :param weights: Relative importance of each skill, default is the player's own weights. None weighs all skills
+            equally.
         :type weights: dict
         :param skills: Which skills to include in calculation of overall score, default is 'all'
-        :type skills: str or list
+        :type skills: str or tuple
         :return: Player's overall score
         :rtype: float
         """
 
+        if weights is WEIGHTS:
+            weights = self.weights
+
+        # Scores over all skills are precomputed for the whole league in one go
+        if skills == "all" and weights is not None:
+            score = self.get_snapshot().weighted_scores(self.league_id, weights).get(self.name)
+            if score is None:
+                logger.warning(f"{self.name} has no votes. Defaulting to an overall score of {ratings.DEFAULT_SCORE}.")
+                return ratings.DEFAULT_SCORE
+            return score
+
         scores = self.get_skill_scores(skills)
 
         if weights is None:
-            return np.average(scores)
+            return sum(scores.values()) / len(scores)
         else:
-            skill_weights = [weights[skill] for skill in scores.keys()]
-            return np.average(scores, weights=skill_weights)
+            weighted_total = sum(score * weights[skill] for skill, score in scores.items())
+            return weighted_total / sum(weights[skill] for skill in scores)
 
-    @cached(cache=cache, key=partial(hashkey, '__str__'))
+    @instrumentation.cached(cache=cache, key=partial(hashkey, 'get_score_variance'), lock=cache_lock)
+    def get_score_variance(self):
+        """
+        How much the ratings behind the player's overall score disagree, i.e. how much their form might vary on the day.
+        :return: Variance of the player's overall score across the votes cast on them
+        :rtype: float
+        """
+        variance = self.get_snapshot().weighted_variances(self.league_id, self.weights).get(self.name)
+        return ratings.DEFAULT_VARIANCE if variance is None else variance
+
+    @instrumentation.cached(cache=cache, key=partial(hashkey, '__str__'), lock=cache_lock)
     def __str__(self):
         player_score = self.get_overall_score()
         return f"Name: {self.name}, Score: {player_score}"
@@ -161,6 +187,28 @@ class Team:
         b = other_team.get_players()
         return list(set(a) & set(b))
 
+    def win_probability(self, other_team, simulations=SIMULATIONS):
+        """
+        Estimate how often this team beats another by simulating matches. In each simulated match every player plays at
+        a level drawn from a normal distribution around their overall score, spread as widely as their ratings, and the
+        team with the higher average level wins. All matches are drawn at once as a single array.
+        :param other_team: The opposing team.
+        :param simulations: Number of matches to simulate.
+        :return: Share of simulated matches this team won, between 0 and 1
+        :rtype: float
+        """
+        import numpy as np  # only needed once teams are balanced, like the ratings matrices
+
+        players = self._players + other_team._players
+        means = np.array([player.get_overall_score() for player in players], dtype=float)
+        deviations = np.sqrt([player.get_score_variance() for player in players])
+
+        levels = np.random.RandomState().standard_normal((simulations, len(players))) * deviations + means
+        size = len(self._players)
+        # Averages rather than totals, so a team isn't favoured just for having an extra player
+        won = levels[:, :size].mean(axis=1) > levels[:, size:].mean(axis=1)
+        return float(won.mean())
+
     def team_difference(self, other_team):
         """
         Calculate the point difference between one team and another team.
@@ -188,7 +236,119 @@ class Team:
         return "\n".join(out)
 
 
-def balance_teams(players, team_size=5, threshold=0.5, max_cycles=20, **kwargs):
+class LineupConstraints:
+
+    def __init__(self, together=None, apart=None, spread=None):
+        """
+        Declarative rules that every generated lineup must satisfy. Names that aren't in the roster being balanced
+        are ignored, so the same constraints can be reused from week to week.
+        :param together: Groups of player names that must end up on the same team, e.g. [("Tom Smith", "Tim Smith")].
+        :param apart: Pairs of player names that must never end up on the same team.
+        :param spread: Groups of player names to split as evenly as possible between the two teams, e.g. passing
+            [("Keeper One", "Keeper Two")] gives each team one goalkeeper.
+        """
+        self.together = [tuple(group) for group in together or []]
+        self.apart = [tuple(pair) for pair in apart or []]
+        self.spread = [tuple(group) for group in spread or []]
+
+        assert all([len(pair) == 2 for pair in self.apart]), \
+            "Please provide 'apart' constraints as pairs of player names."
+
+    def compile(self, players):
+        """
+        Compile the constraints into bitmasks over a roster, where bit i stands for players[i].
+        :param players: List of player names, in the order used to generate candidate lineups.
+        :return: Filter that accepts or rejects (partial) lineups.
+        :rtype: LineupFilter
+        """
+        bits = {name: 1 << i for i, name in enumerate(players)}
+
+        def to_mask(group):
+            mask = 0
+            for name in group:
+                mask |= bits.get(name, 0)
+            return mask
+
+        together = [mask for mask in map(to_mask, self.together) if bin(mask).count("1") > 1]
+        apart = [mask for mask in map(to_mask, self.apart) if bin(mask).count("1") == 2]
+
+        spread = []
+        for mask in map(to_mask, self.spread):
+            size = bin(mask).count("1")
+            if size > 1:
+                spread.append((mask, size // 2, size - size // 2))
+
+        return LineupFilter(together, apart, spread)
+
+
+class LineupFilter:
+
+    def __init__(self, together, apart, spread):
+        """
+        Bitmask form of LineupConstraints for one roster.
+        :param together: Masks of players that must share a team.
+        :param apart: Masks of two players that must not share a team.
+        :param spread: Tuples of (mask, min, max) giving how many of the masked players a team may hold.
+        """
+        self.together = together
+        self.apart = apart
+        self.spread = spread
+
+    def admits(self, chosen, decided):
+        """
+        Check whether a (partial) lineup can still be completed without breaking a constraint. Players outside the
+        lineup form the opposing team, so every rule is checked from both sides.
+        :param chosen: Bitmask of players picked for the lineup so far.
+        :param decided: Bitmask of players that have been either picked or passed over.
+        :return: False if no completion of the lineup can satisfy the constraints.
+        :rtype: bool
+        """
+        passed_over = decided & ~chosen
+
+        for mask in self.together:
+            if chosen & mask and passed_over & mask:
+                return False
+
+        for mask in self.apart:
+            if chosen & mask == mask or passed_over & mask == mask:
+                return False
+
+        for mask, low, high in self.spread:
+            picked = bin(chosen & mask).count("1")
+            if picked > high or picked + bin(mask & ~decided).count("1") < low:
+                return False
+
+        return True
+
+
+def candidate_lineups(n_players, team_size, lineup_filter):
+    """
+    Generate every lineup of team_size players that satisfies the constraints, in the same order as
+    itertools.combinations. Partial lineups are checked as they're built, so infeasible branches of the combination
+    space are pruned before any team gets scored.
+    :param n_players: Int. Number of players in the roster.
+    :param team_size: Int. Number of players in the lineup.
+    :param lineup_filter: LineupFilter compiled for the roster.
+    :return: Generator of lineup bitmasks, where bit i stands for the i-th player.
+    """
+    everyone = (1 << n_players) - 1
+
+    def extend(start, chosen, decided, remaining):
+        if not lineup_filter.admits(chosen, decided):
+            return
+        if remaining == 0:
+            if lineup_filter.admits(chosen, everyone):  # everyone left over plays for the other team
+                yield chosen
+            return
+        for i in range(start, n_players - remaining + 1):
+            bit = 1 << i
+            yield from extend(i + 1, chosen | bit, (bit << 1) - 1, remaining - 1)
+
+    return extend(0, 0, 0, team_size)
+
+
+def balance_teams(players, team_size=5, threshold=0.5, max_cycles=20, constraints=None, league=None, weights=None,
+                  snapshot=None, **kwargs):
     """
     Recursive function to finds all possible team configurations for a set of players. If none are found within the
     threshold, it returns the closest match.
@@ -196,31 +356,48 @@ def balance_teams(players, team_size=5, threshold=0.5, max_cycles=20, **kwargs):
     :param team_size: Int. Number of players in each team.
     :param threshold: Float. User-specified maximum point difference allowed between teams.
     :param max_cycles: How many times to iterate while increasing threshold on failed matching.
+    :param constraints: (Optional) LineupConstraints that every generated team must satisfy.
+    :param league: (Optional) League whose ratings to balance with.
+    :param weights: (Optional) Dictionary of skill name to weight, e.g. from a WeightProfile. Defaults to WEIGHTS.
+    :param snapshot: (Optional) RatingsSnapshot to balance with, to balance as of a saved ratings history. Defaults to
+        the current ratings.
     :param kwargs: Extra named arguments. Used mainly to prevent infinte recursion.
-    :return: Dictionary of match configuration.
+    :return: Dictionary of match configuration and each team's estimated win probability, or None if no valid
+        configuration exists.
     """
 
     even_teams = len(players) % 2 == 0
 
     if team_size is None:
         team_size = math.floor(len(players) / 2)
-        logging.info(f"Team size set to {team_size}")
+        logger.debug(f"Team size set to {team_size}")
+
+    instrumentation.tag("solver", "exhaustive")
 
-    team_combos = list(combinations(players, team_size))
+    # Constraints are applied while lineups are generated, so infeasible lineups never become Team objects
+    with instrumentation.timer("lineups"):
+        lineup_filter = (constraints or LineupConstraints()).compile(players)
+        team_masks = list(candidate_lineups(len(players), team_size, lineup_filter))
 
-    # If uneven team matching
-    if not even_teams:
-        second_team_size = len(players) - team_size
-        logging.info(
-            f"Uneven number of players detected. Splitting into teams of {team_size} and {second_team_size}.")
-        team_combos += list(combinations(players, second_team_size))
+        # If uneven team matching
+        if not even_teams:
+            second_team_size = len(players) - team_size
+            logger.debug(
+                f"Uneven number of players detected. Splitting into teams of {team_size} and {second_team_size}.")
+            team_masks += list(candidate_lineups(len(players), second_team_size, lineup_filter))
+
+    instrumentation.incr("candidate_lineups", len(team_masks))
+
+    if len(team_masks) == 0:
+        logger.warning("No team configuration satisfies the lineup constraints.")
+        return None
 
     # Create a Team object from each combination
-    player_objects = [Player(player) for player in players]
+    player_objects = [Player(player, league, weights, snapshot) for player in players]
 
     teams = []
-    for combo in team_combos:
-        team_players = [p for p in player_objects if p.get_name() in combo]
+    for mask in team_masks:
+        team_players = [p for i, p in enumerate(player_objects) if mask >> i & 1]
         team = Team(name="", players=team_players)
         teams.append(team)
 
@@ -246,23 +423,22 @@ def balance_teams(players, team_size=5, threshold=0.5, max_cycles=20, **kwargs):
                     if abs(team_a.team_difference(team)) <= threshold:
                         matched_teams.append(team)
 
-        logging.info(f"{len(matched_teams)} matches found")
+        instrumentation.incr("splits_evaluated", len(teams))
+        logger.debug(f"{len(matched_teams)} matches found")
 
         # Base cases
         if len(matched_teams) == 0:  # no matches found
             if len(teams) == 1:  # all possible teams have been analysed
-                try:
-                    attempts += 1
-                except NameError:
-                    attempts = 1
+                attempts = kwargs.get("attempts", 0) + 1
 
                 if attempts <= max_cycles:  # increase threshold max number of times
-                    logging.info(f"No matches found at current threshold level. Raising by 0.5 to {threshold + 1.5}.")
-                    return balance_teams(players, team_size, threshold + 1.5, attempts=attempts)
+                    logger.debug(f"No matches found at current threshold level. Raising by 0.5 to {threshold + 1.5}.")
+                    return balance_teams(players, team_size, threshold + 1.5, max_cycles, constraints, league,
+                                         weights, snapshot, attempts=attempts)
                 else:
                     return None
             else:
-                logging.info("No matches found this time, moving down the list.")
+                logger.debug("No matches found this time, moving down the list.")
                 del teams[i]
                 return find_matches(teams)
         else:
@@ -272,20 +448,23 @@ def balance_teams(players, team_size=5, threshold=0.5, max_cycles=20, **kwargs):
                 "team_b": choice(matched_teams)
             })
 
-            # Print team information
             for k, v in result.items():
-                print(f"{k} score: {v.get_team_score()}")
-                print(f"{k} players: {v.get_players()}")
+                logger.debug(f"{k} score: {v.get_team_score()}, players: {v.get_players()}")
+
+            with instrumentation.timer("simulation"):
+                win_probability = result['team_a'].win_probability(result['team_b'])
 
             # Don't send individual players' scores to the front end
             result_restricted = {
                 'team_a': result['team_a'].get_players(),
-                'team_b': result['team_b'].get_players()
+                'team_b': result['team_b'].get_players(),
+                'win_probability': {'team_a': win_probability, 'team_b': 1 - win_probability},
             }
 
             return result_restricted
 
-    return find_matches(teams=teams)
+    with instrumentation.timer("matching"):
+        return find_matches(teams=teams)
 
 
 def main(players, team_size=5, threshold=0.5):
@@ -1,3 +1,1107 @@
-from django.test import TestCase
+import csv
+import gzip
+import importlib
+import itertools
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from datetime import timedelta
+from io import StringIO
+from unittest import mock
 
-# Create your tests here.
+from django.apps import apps
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.core.cache import cache
+from django.db.models import Avg
+from django.http import HttpResponse
+from django.template import Context, Template
+from django.test import TestCase, RequestFactory, override_settings
+from django.urls import reverse
+from django.utils import timezone
+
+from . import directory, jobs, ratings, routers, urls
+from .forms import RosterForm, VotingForm, bulk_vote_formset
+from .instrumentation import QueryBudgetExceeded, cached, query_budget
+from .middleware import PerformanceMiddleware, ReplicaStickinessMiddleware
+from .leagues import get_default_league, get_user_leagues, get_weight_profiles, join_league
+from .models import BalancingJob, League, Membership, RatingsHistory, Roster, Votes, WeightProfile
+from .teamBalancer import LineupConstraints, Player, Team, balance_teams, candidate_lineups
+from .versions import bump_version, get_version, remembered
+
+SKILLS = ('attack', 'defense', 'possession', 'stamina', 'mobility')
+
+
+def seed_club(n_users=12, league=None, prefix="player"):
+    """
+    Register n_users players in a league and have each of them rate everyone else, so that any query that runs once
+    per player or once per vote shows up as a blown budget.
+    :param league: (Optional) League to register the players in, defaults to the default league.
+    :param prefix: Username prefix, so more than one club can be seeded.
+    :return: The registered users
+    :rtype: list
+    """
+    league = league or get_default_league()
+    users = [User.objects.create_user(f"{prefix}{i}", password="not-a-real-password",
+                                      first_name=f"First{i}", last_name=f"Last{i}")
+             for i in range(n_users)]
+    Membership.objects.bulk_create(Membership(league=league, user=user) for user in users)
+    Votes.objects.bulk_create(
+        Votes(league=league, user=voter, player=f"{player.first_name} {player.last_name}",
+              **{skill: (voter.pk + player.pk) % 10 + 1 for skill in SKILLS})
+        for voter in users for player in users if voter != player
+    )
+    return users
+
+
+def bulk_vote_data(user, rating):
+    """
+    Fill in every row of a user's bulk rating page in the default league with the same rating.
+    :return: POST data
+    :rtype: dict
+    """
+    formset = bulk_vote_formset(user.pk, get_default_league())
+    data = {f"form-{field}": value for field, value in formset.management_form.initial.items()}
+    for i, form in enumerate(formset.forms):
+        data[f"form-{i}-player"] = form['player'].value()
+        if form.instance.pk:
+            data[f"form-{i}-id"] = form.instance.pk
+        for skill in SKILLS:
+            data[f"form-{i}-{skill}"] = rating
+    return data
+
+
+@override_settings(QUERY_BUDGETS_ENFORCED=True)
+class QueryBudgetTests(TestCase):
+    """
+    Requests every URL in myapp/urls.py against a seeded database. Each request fails with QueryBudgetExceeded if its
+    view goes over the query budget it declares.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.users = seed_club()
+        cls.user = cls.users[0]
+        cls.vote = Votes.objects.filter(user=cls.user).first()
+        cls.roster = [f"{user.first_name} {user.last_name}" for user in cls.users[:10]]
+
+    def setUp(self):
+        cache.clear()
+        self.client.force_login(self.user)
+
+    def test_every_url_declares_a_budget(self):
+        for pattern in urls.urlpatterns:
+            self.assertIsNotNone(getattr(pattern.callback, 'query_budget', None), pattern.name)
+
+    def test_home(self):
+        self.assertEqual(self.client.get(reverse('home')).status_code, 200)
+
+    def test_vote_list(self):
+        self.assertEqual(self.client.get(reverse('vote_list')).status_code, 200)
+
+    def test_vote_new(self):
+        self.assertEqual(self.client.get(reverse('vote_new')).status_code, 200)
+
+    def test_vote_new_submit(self):
+        Votes.objects.filter(user=self.user, player="First1 Last1").delete()
+        data = dict({skill: 7 for skill in SKILLS}, player="First1 Last1")
+        self.assertEqual(self.client.post(reverse('vote_new'), data).status_code, 302)
+
+    def test_vote_bulk(self):
+        Votes.objects.filter(user=self.user).delete()
+        self.assertEqual(self.client.get(reverse('vote_bulk')).status_code, 200)
+
+    def test_vote_bulk_submit(self):
+        Votes.objects.filter(user=self.user, player__in=self.roster[5:]).delete()
+        response = self.client.post(reverse('vote_bulk'), bulk_vote_data(self.user, rating=9))
+        self.assertEqual(response.status_code, 302)
+
+    def test_vote_detail(self):
+        self.assertEqual(self.client.get(reverse('vote_detail', kwargs={'pk': self.vote.pk})).status_code, 200)
+
+    def test_vote_edit(self):
+        self.assertEqual(self.client.get(reverse('vote_edit', kwargs={'pk': self.vote.pk})).status_code, 200)
+
+    def test_vote_edit_submit(self):
+        data = dict({skill: 3 for skill in SKILLS}, player=self.vote.player)
+        response = self.client.post(reverse('vote_edit', kwargs={'pk': self.vote.pk}), data)
+        self.assertEqual(response.status_code, 302)
+
+    def test_signup(self):
+        self.client.logout()
+        self.assertEqual(self.client.get(reverse('signup')).status_code, 200)
+
+    def test_roster_selection(self):
+        self.assertEqual(self.client.get(reverse('roster_selection')).status_code, 200)
+
+    def test_roster_selection_submit(self):
+        response = self.client.post(reverse('roster_selection'), {'players': self.roster})
+        self.assertEqual(response.status_code, 302)
+
+    def test_thank_you(self):
+        self.assertEqual(self.client.get(reverse('thank_you')).status_code, 200)
+
+    def test_export_ratings(self):
+        self.assertEqual(self.client.get(reverse('export_ratings', args=['csv'])).status_code, 200)
+
+    def test_export_rosters(self):
+        self.assertEqual(self.client.get(reverse('export_rosters', args=['json'])).status_code, 200)
+
+    def test_league_switch(self):
+        league = League.objects.create(name="Sunday League", slug="sunday")
+        join_league(self.user, league)
+        self.assertEqual(self.client.get(reverse('league_switch', kwargs={'slug': league.slug})).status_code, 302)
+
+    def test_team_rosters(self):
+        session = self.client.session
+        session['players'] = self.roster
+        session.save()
+        self.assertEqual(self.client.get(reverse('team_rosters')).status_code, 200)
+
+
+class QueryBudgetEnforcementTests(TestCase):
+
+    def run_view(self, budget, queries):
+        @query_budget(budget)
+        def view(request):
+            for _ in range(queries):
+                User.objects.count()
+            return HttpResponse()
+
+        request = RequestFactory().get('/')
+        middleware = PerformanceMiddleware(lambda r: middleware.process_view(r, view, (), {}) or view(r))
+        return middleware(request)
+
+    @override_settings(QUERY_BUDGETS_ENFORCED=True)
+    def test_over_budget_fails_with_queries_and_locations(self):
+        with self.assertRaises(QueryBudgetExceeded) as raised:
+            self.run_view(budget=1, queries=2)
+        message = str(raised.exception)
+        self.assertIn("ran 2 queries, over its budget of 1", message)
+        self.assertIn('SELECT COUNT(*)', message)
+        self.assertIn('myapp/tests.py', message)
+
+    @override_settings(QUERY_BUDGETS_ENFORCED=True)
+    def test_within_budget_passes(self):
+        self.assertEqual(self.run_view(budget=2, queries=2).status_code, 200)
+
+    @override_settings(QUERY_BUDGETS_ENFORCED=False)
+    def test_not_enforced(self):
+        self.assertEqual(self.run_view(budget=0, queries=2).status_code, 200)
+
+    @override_settings(QUERY_BUDGETS_ENFORCED=True, CACHES={'default': {
+        'BACKEND': 'django.core.cache.backends.db.DatabaseCache', 'LOCATION': 'myapp_test_cache'}})
+    def test_database_cache_queries_not_counted(self):
+        call_command('createcachetable', verbosity=0)
+        users = seed_club(n_users=6)
+        self.client.force_login(users[0])
+        for name in ('home', 'vote_list', 'vote_new', 'roster_selection'):
+            for _ in ('cold', 'warm'):
+                with self.assertLogs('myapp.performance', 'INFO') as logs:
+                    self.assertEqual(self.client.get(reverse(name)).status_code, 200)
+                self.assertGreater(json.loads(logs.records[-1].getMessage())['cache_queries'], 0)
+
+
+class PerformanceLogTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.users = seed_club(n_users=6)
+
+    def setUp(self):
+        cache.clear()
+        self.client.force_login(self.users[0])
+        self.client.post(reverse('roster_selection'), {'players': [f"First{i} Last{i}" for i in range(4)]})
+
+    @override_settings(PERFORMANCE_SERVER_TIMING=True)
+    def test_team_rosters_logged_and_timed(self):
+        with self.assertLogs('myapp.performance', 'INFO') as logs:
+            response = self.client.get(reverse('team_rosters'))
+
+        record = json.loads(logs.records[-1].getMessage())
+        self.assertEqual((record['view'], record['status'], record['query_budget']), ('team_rosters', 200, 5))
+        self.assertEqual(record['solver'], 'exhaustive')
+        self.assertEqual(record['candidate_lineups'], 6)  # every pair of the 4 players
+        self.assertGreater(record['splits_evaluated'], 0)
+        self.assertGreater(record['cache_hits'], 0)
+        self.assertGreater(record['queries'], 0)
+        for timing in ('wall_ms', 'query_ms', 'lineups_ms', 'matching_ms', 'simulation_ms'):
+            self.assertIn(timing, record)
+
+        server_timing = response['Server-Timing']
+        self.assertRegex(server_timing, r'^total;dur=[\d.]+, db;dur=[\d.]+;desc="\d+ queries"')
+        for timing in ('lineups', 'matching', 'simulation'):
+            self.assertIn(f"{timing};dur=", server_timing)
+
+    def test_server_timing_off_by_default(self):
+        with self.assertLogs('myapp.performance', 'INFO'):
+            self.assertNotIn('Server-Timing', self.client.get(reverse('team_rosters')))
+
+
+class CachedTests(TestCase):
+
+    def test_cache_is_only_touched_under_the_lock(self):
+        lock = threading.Lock()
+
+        class LockedCache(dict):
+            def __getitem__(self, k):
+                assert lock.locked(), "read without the lock"
+                return super(LockedCache, self).__getitem__(k)
+
+            def __setitem__(self, k, value):
+                assert lock.locked(), "written without the lock"
+                super(LockedCache, self).__setitem__(k, value)
+
+        @cached(cache=LockedCache(), key=lambda x: x, lock=lock)
+        def double(x):
+            self.assertFalse(lock.locked())  # the function runs without it
+            return x * 2
+
+        self.assertEqual([double(1), double(1)], [2, 2])
+
+
+class DirectoryTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.league = get_default_league()
+        cls.users = seed_club(n_users=4)
+
+    def setUp(self):
+        cache.clear()
+
+    def test_unvoted_players_excludes_self_and_voted(self):
+        user = User.objects.create_user("newbie", first_name="New", last_name="Player")
+        join_league(user, self.league)
+        Votes.objects.create(league=self.league, user=user, player="First0 Last0")
+        self.assertEqual(directory.get_unvoted_players(user.pk, self.league),
+                         ["First1 Last1", "First2 Last2", "First3 Last3"])
+
+    def test_warm_form_runs_no_queries(self):
+        uid = self.users[0].pk
+        VotingForm(uid=uid, league=self.league)
+        RosterForm(league=self.league)
+        with self.assertNumQueries(0):
+            VotingForm(uid=uid, league=self.league)
+            RosterForm(league=self.league)
+
+    def test_signup_and_profile_change_invalidate(self):
+        directory.get_player_names(self.league)
+        user = User.objects.create_user("newbie", first_name="New", last_name="Player")
+        join_league(user, self.league)
+        self.assertIn("New Player", directory.get_player_names(self.league))
+
+        user.first_name = "Renamed"
+        user.save()
+        self.assertIn("Renamed Player", directory.get_player_names(self.league))
+
+        with self.assertNumQueries(1):
+            user.save(update_fields=['last_login'])  # logging in keeps the cached directory
+            directory.get_player_names(self.league)
+
+    def test_voting_invalidates(self):
+        voter = self.users[0]
+        Votes.objects.filter(user=voter, player="First1 Last1").delete()
+        self.assertIn("First1 Last1", directory.get_unvoted_players(voter.pk, self.league))
+        Votes.objects.create(league=self.league, user=voter, player="First1 Last1")
+        self.assertNotIn("First1 Last1", directory.get_unvoted_players(voter.pk, self.league))
+
+    def test_versions_read_once_per_request(self):
+        with remembered():
+            version = get_version('directory')
+            with mock.patch.object(cache, 'get', side_effect=AssertionError("read from the cache again")):
+                self.assertEqual(get_version('directory'), version)
+                bumped = bump_version('directory')
+                self.assertEqual(get_version('directory'), bumped)
+        self.assertGreater(get_version('directory'), version)
+
+    def test_unshared_cache_is_stale_for_at_most_cache_timeout(self):
+        voter = self.users[0]
+        Votes.objects.filter(user=voter, player="First1 Last1").delete()
+        self.assertIn("First1 Last1", directory.get_unvoted_players(voter.pk, self.league))
+        # A vote saved by another process, whose version bump this process's local memory cache never sees
+        Votes.objects.bulk_create([Votes(league=self.league, user=voter, player="First1 Last1")])
+        self.assertIn("First1 Last1", directory.get_unvoted_players(voter.pk, self.league))
+
+        with mock.patch('time.time', return_value=time.time() + settings.CACHE_TIMEOUT + 1):
+            self.assertNotIn("First1 Last1", directory.get_unvoted_players(voter.pk, self.league))
+
+
+class BulkVoteTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.users = seed_club(n_users=5)
+        cls.user = cls.users[0]
+
+    def setUp(self):
+        cache.clear()
+        self.client.force_login(self.user)
+
+    def test_creates_and_updates_in_one_batch(self):
+        Votes.objects.filter(user=self.user, player__in=["First1 Last1", "First2 Last2"]).delete()
+        data = bulk_vote_data(self.user, rating=9)
+        ratings_version = get_version(f'ratings:{get_default_league().pk}')
+
+        self.assertEqual(self.client.post(reverse('vote_bulk'), data).status_code, 302)
+
+        votes = Votes.objects.filter(user=self.user)
+        self.assertEqual(votes.count(), 4)
+        self.assertTrue(all(vote.attack == 9 and vote.published_date for vote in votes))
+        self.assertEqual(get_version(f'ratings:{get_default_league().pk}'), ratings_version + 1)
+
+    def test_skipped_rows_are_not_saved(self):
+        Votes.objects.filter(user=self.user).delete()
+        data = bulk_vote_data(self.user, rating=7)
+        data['form-0-skip'] = 'on'
+
+        self.client.post(reverse('vote_bulk'), data)
+
+        self.assertEqual(Votes.objects.filter(user=self.user).count(), 3)
+
+    def test_invalid_row_saves_nothing(self):
+        Votes.objects.filter(user=self.user).delete()
+        data = bulk_vote_data(self.user, rating=7)
+        data['form-1-attack'] = 11
+
+        self.assertEqual(self.client.post(reverse('vote_bulk'), data).status_code, 200)
+        self.assertFalse(Votes.objects.filter(user=self.user).exists())
+
+
+class RatingsSnapshotTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.users = seed_club(n_users=4)
+
+    def setUp(self):
+        cache.clear()
+
+    def test_built_with_one_aggregate_query(self):
+        with self.assertNumQueries(2):  # the leagues, then the aggregate over every vote
+            snapshot = ratings.refresh()
+        self.assertEqual(len(snapshot), 4)
+        expected = Votes.objects.filter(player="First0 Last0").aggregate(avg=Avg('attack'))['avg']
+        attack = snapshot.get("First0 Last0", get_default_league().pk)[ratings.SKILLS.index('attack')]
+        self.assertEqual(attack, expected)
+
+    def test_vote_makes_snapshot_stale(self):
+        before = ratings.get_snapshot()
+        self.assertIs(ratings.get_snapshot(), before)
+
+        league = get_default_league()
+        Votes.objects.create(league=league, user=self.users[1], player="Someone New", attack=10)
+
+        after = ratings.get_snapshot()
+        self.assertIsNot(after, before)
+        self.assertEqual(after.get("Someone New", league.pk)[0], 10)
+
+
+    def test_refresher_started_by_wsgi_application_only(self):
+        with mock.patch('myapp.ratings.start_refresher') as start_refresher:
+            apps.get_app_config('myapp').ready()  # e.g. python -m django migrate
+            start_refresher.assert_not_called()
+
+            with override_settings(RATINGS_SNAPSHOT_PRELOAD=True), mock.patch.dict(sys.modules):
+                sys.modules.pop('myproject.wsgi', None)
+                importlib.import_module('myproject.wsgi')
+        start_refresher.assert_called_once()
+
+
+@override_settings(RATINGS_READ_DATABASE='replica')
+class ReplicaRoutingTests(TestCase):
+    """
+    Runs against two SQLite databases. Nothing replicates between them, which makes it easy to see where each read
+    was routed: the replica never sees writes made through the app.
+    """
+
+    databases = {'default', 'replica'}
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.league = get_default_league()
+        cls.user = User.objects.create_user("voter", password="not-a-real-password",
+                                            first_name="Vo", last_name="Ter")
+        join_league(cls.user, cls.league)
+        join_league(User.objects.create_user("rated", first_name="Ra", last_name="Ted"), cls.league)
+
+    def setUp(self):
+        cache.clear()
+
+    def test_votes_written_to_primary_and_read_from_replica(self):
+        Votes.objects.create(league=self.league, user=self.user, player="Ra Ted")
+        self.assertEqual(Votes.objects.using('default').count(), 1)
+        self.assertEqual(Votes.objects.count(), 0)
+
+    def test_other_models_read_from_primary(self):
+        self.assertEqual(User.objects.count(), 2)
+
+    def test_pinned_reads_use_primary(self):
+        Votes.objects.create(league=self.league, user=self.user, player="Ra Ted")
+        with routers.pinned_to_primary():
+            self.assertEqual(Votes.objects.count(), 1)
+
+    def test_session_reads_its_own_writes_after_voting(self):
+        self.client.force_login(self.user)
+        data = dict({skill: 8 for skill in SKILLS}, player="Ra Ted")
+        self.client.post(reverse('vote_new'), data)
+
+        self.assertContains(self.client.get(reverse('vote_list')), "Ra Ted")
+
+        del self.client.cookies[ReplicaStickinessMiddleware.cookie_name]
+        cache.clear()  # the cached vote list would hide where the votes are read from
+        self.assertNotContains(self.client.get(reverse('vote_list')), "Ra Ted")
+
+    def test_snapshot_rebuilt_for_a_vote_reads_primary(self):
+        ratings.refresh()
+        Votes.objects.create(league=self.league, user=self.user, player="Ra Ted", attack=9)
+        self.assertEqual(ratings.get_snapshot().for_league(self.league.pk)["Ra Ted"][0], 9)
+
+    def test_refresher_woken_by_a_vote_reads_primary(self):
+        refresher = ratings.SnapshotRefresher(interval=300, poll=5)
+        ratings.refresh()
+        Votes.objects.create(league=self.league, user=self.user, player="Ra Ted", attack=9)
+        refresher.refresh_if_stale()
+        self.assertEqual(ratings.get_snapshot().for_league(self.league.pk)["Ra Ted"][0], 9)
+
+        ratings._snapshot.built_at -= 300  # past the interval, without a vote
+        refresher.refresh_if_stale()
+        self.assertNotIn("Ra Ted", ratings.get_snapshot().for_league(self.league.pk))
+
+
+class LeagueTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.home = get_default_league()
+        cls.away = League.objects.create(name="Away League", slug="away")
+        cls.home_users = seed_club(n_users=4, league=cls.home, prefix="home")
+        cls.away_users = seed_club(n_users=3, league=cls.away, prefix="away")
+        cls.away_users[0].first_name = "Only"
+        cls.away_users[0].save()
+        Votes.objects.filter(league=cls.away, player="First0 Last0").update(player="Only Last0")
+
+    def setUp(self):
+        cache.clear()
+        self.client.force_login(self.home_users[0])
+
+    def test_forms_only_list_league_members(self):
+        self.assertEqual(len(RosterForm(league=self.away).fields['players'].choices), 3)
+        self.assertNotIn("Only Last0", directory.get_player_names(self.home))
+
+    def test_vote_list_only_shows_active_league(self):
+        Votes.objects.create(league=self.away, user=self.home_users[0], player="Only Last0")
+        self.assertNotContains(self.client.get(reverse('vote_list')), "Only Last0")
+
+    def test_ratings_are_kept_per_league(self):
+        snapshot = ratings.refresh()
+        self.assertEqual(len(snapshot.for_league(self.home.pk)), 4)
+        self.assertIsNone(snapshot.get("Only Last0", self.home.pk))
+        self.assertIsNotNone(snapshot.get("Only Last0", self.away.pk))
+
+    def test_vote_only_rebuilds_its_league(self):
+        before = ratings.refresh()
+        Votes.objects.create(league=self.away, user=self.away_users[1], player="Only Last0", attack=10)
+
+        with self.assertNumQueries(1):  # the away league's votes
+            after = ratings.get_snapshot(self.away.pk)
+        self.assertIs(after.for_league(self.home.pk), before.for_league(self.home.pk))
+        self.assertNotEqual(after.get("Only Last0", self.away.pk), before.get("Only Last0", self.away.pk))
+        self.assertIs(ratings.get_snapshot(self.home.pk), after)
+
+    def test_vote_keeps_other_leagues_cached(self):
+        self.client.get(reverse('vote_list'))
+        directory_version = get_version(f'directory:{self.home.pk}')
+        ratings_version = get_version(f'ratings:{self.home.pk}')
+
+        Votes.objects.create(league=self.away, user=self.away_users[1], player="Only Last0")
+        join_league(self.home_users[1], self.away)
+
+        self.assertEqual(get_version(f'directory:{self.home.pk}'), directory_version)
+        self.assertEqual(get_version(f'ratings:{self.home.pk}'), ratings_version)
+
+    def test_active_league_looked_up_once_per_request(self):
+        join_league(self.home_users[0], self.away)
+        with mock.patch('myapp.leagues.get_user_leagues', wraps=get_user_leagues) as lookup:
+            response = self.client.get(reverse('vote_list'))
+        self.assertContains(response, "Away League")  # in the league bar, from the same lookup
+        self.assertEqual(lookup.call_count, 1)
+
+    def test_switching_to_a_league_you_are_not_in_is_forbidden(self):
+        response = self.client.get(reverse('league_switch', kwargs={'slug': self.away.slug}))
+        self.assertEqual(response.status_code, 403)
+
+    def test_switched_league_scopes_votes(self):
+        join_league(self.home_users[0], self.away)
+        self.client.get(reverse('league_switch', kwargs={'slug': self.away.slug}))
+        self.client.post(reverse('vote_new'), dict({skill: 6 for skill in SKILLS}, player="Only Last0"))
+        self.assertTrue(Votes.objects.filter(league=self.away, player="Only Last0").exists())
+
+    def test_signup_joins_invited_league(self):
+        self.client.logout()
+        self.client.post(reverse('signup') + '?league=away', {
+            'username': 'invitee', 'first_name': 'In', 'last_name': 'Vitee', 'email': 'invitee@example.com',
+            'password1': 'a-long-enough-password', 'password2': 'a-long-enough-password',
+        })
+        self.assertEqual(list(User.objects.get(username='invitee').leagues.all()), [self.away])
+
+
+class WeightProfileTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.league = get_default_league()
+        cls.users = seed_club(n_users=4, league=cls.league)
+        cls.attackers = WeightProfile.objects.create(league=cls.league, name="Attackers", attack=5, defense=0,
+                                                     possession=1, stamina=0, mobility=0, is_default=True)
+
+    def setUp(self):
+        cache.clear()
+        self.client.force_login(self.users[0])
+
+    def test_weighted_scores_match_per_skill_scores(self):
+        weights = self.attackers.as_weights()
+        snapshot = ratings.get_snapshot()
+        scores = snapshot.weighted_scores(self.league.pk, weights)
+        self.assertIs(snapshot.weighted_scores(self.league.pk, dict(weights)), scores)
+
+        player = Player("First1 Last1", self.league, weights)
+        skills = player.get_skill_scores()
+        expected = sum(skills[skill] * weight for skill, weight in weights.items()) / sum(weights.values())
+        self.assertAlmostEqual(player.get_overall_score(), expected)
+        self.assertAlmostEqual(scores["First1 Last1"], expected)
+
+    def test_league_default_profile_comes_first(self):
+        self.assertEqual([profile.name for profile in get_weight_profiles(self.league)], ["Attackers", "Standard"])
+
+    def test_roster_keeps_selected_profile(self):
+        standard = WeightProfile.objects.get(name="Standard")
+        self.client.post(reverse('roster_selection'), {'players': ["First1 Last1", "First2 Last2"],
+                                                       'weight_profile': standard.pk})
+        self.assertEqual(Roster.objects.get().weight_profile, standard)
+        self.assertEqual(self.client.session['weights'], standard.as_weights())
+
+
+def brute_force_lineups(players, team_size, constraints):
+    """
+    Every lineup of team_size players satisfying the constraints, worked out by checking each combination in full.
+    :return: Lineup bitmasks, in itertools.combinations order
+    :rtype: list
+    """
+    lineups = []
+    for combination in itertools.combinations(range(len(players)), team_size):
+        team = {players[i] for i in combination}
+        other = set(players) - team
+        groups = [set(group) & set(players) for group in constraints.together]
+        pairs = [set(pair) for pair in constraints.apart if set(pair) <= set(players)]
+        spreads = [set(group) & set(players) for group in constraints.spread]
+        if (all(group <= team or group <= other for group in groups)
+                and all(not (pair <= team or pair <= other) for pair in pairs)
+                and all(len(group) // 2 <= len(group & team) <= len(group) - len(group) // 2
+                        for group in spreads if len(group) > 1)):
+            lineups.append(sum(1 << i for i in combination))
+    return lineups
+
+
+class LineupConstraintTests(TestCase):
+
+    def check(self, players, constraints):
+        """
+        Compare the pruned lineups with brute force, for both team sizes when the roster is odd.
+        """
+        lineup_filter = constraints.compile(players)
+        for team_size in {len(players) // 2, len(players) - len(players) // 2}:
+            self.assertEqual(list(candidate_lineups(len(players), team_size, lineup_filter)),
+                             brute_force_lineups(players, team_size, constraints))
+
+    def test_together_apart_and_spread(self):
+        players = [f"P{i}" for i in range(8)]
+        self.check(players, LineupConstraints(together=[("P0", "P1", "P2")]))
+        self.check(players, LineupConstraints(apart=[("P0", "P3"), ("P4", "P5")]))
+        self.check(players, LineupConstraints(spread=[("P5", "P6", "P7")]))
+        self.check(players, LineupConstraints(together=[("P0", "P1")], apart=[("P1", "P2")],
+                                               spread=[("P2", "P3", "P4", "P5")]))
+
+    def test_odd_roster(self):
+        players = [f"P{i}" for i in range(7)]
+        self.check(players, LineupConstraints(together=[("P0", "P6")], apart=[("P1", "P2")],
+                                               spread=[("P3", "P4", "P5")]))
+
+    def test_names_outside_the_roster_are_ignored(self):
+        players = [f"P{i}" for i in range(6)]
+        constraints = LineupConstraints(together=[("P0", "Ghost")], apart=[("P1", "Ghost")], spread=[("P2", "Ghost")])
+        self.assertEqual(len(list(candidate_lineups(6, 3, constraints.compile(players)))), 20)
+
+    def test_random_constraints(self):
+        rng = random.Random(0)
+        for _ in range(50):
+            players = [f"P{i}" for i in range(rng.randint(2, 9))]
+            def groups(smallest=2, largest=4):
+                return [tuple(rng.sample(players, rng.randint(smallest, min(largest, len(players)))))
+                        for _ in range(rng.randint(0, 2))]
+
+            self.check(players, LineupConstraints(together=groups(), apart=groups(2, 2), spread=groups()))
+
+    def test_partial_lineups_are_pruned(self):
+        lineup_filter = LineupConstraints(together=[("P0", "P1")], apart=[("P2", "P3")]).compile(
+            ["P0", "P1", "P2", "P3"])
+        self.assertFalse(lineup_filter.admits(chosen=0b01, decided=0b11))  # P0 picked, P1 passed over
+        self.assertFalse(lineup_filter.admits(chosen=0b1100, decided=0b1100))  # P2 and P3 together
+        self.assertTrue(lineup_filter.admits(chosen=0b11, decided=0b11))
+
+    def test_apart_takes_pairs(self):
+        with self.assertRaises(AssertionError):
+            LineupConstraints(apart=[("P0", "P1", "P2")])
+
+    def test_infeasible_constraints(self):
+        players = [f"P{i}" for i in range(4)]
+        constraints = LineupConstraints(together=[("P0", "P1", "P2")])
+        with self.assertLogs('myapp.teamBalancer', 'WARNING'):
+            self.assertIsNone(balance_teams(players, team_size=None, constraints=constraints))
+
+
+class WinProbabilityTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.league = get_default_league()
+        cls.users = seed_club(n_users=6, league=cls.league)
+        voter = cls.users[0]
+        Votes.objects.bulk_create(
+            [Votes(league=cls.league, user=voter, player=f"Strong {i}", **{skill: 10 for skill in SKILLS})
+             for i in range(3)]
+            + [Votes(league=cls.league, user=voter, player=f"Weak {i}", **{skill: 1 for skill in SKILLS})
+               for i in range(3)]
+        )
+
+    def setUp(self):
+        cache.clear()
+
+    def team(self, *names):
+        return Team(name="", players=[Player(name, self.league) for name in names])
+
+    def test_variance_from_votes(self):
+        votes = Votes.objects.filter(player="First1 Last1").values_list('attack', flat=True)
+        mean = sum(votes) / len(votes)
+        expected = sum((vote - mean) ** 2 for vote in votes) / len(votes)
+        variances = ratings.get_snapshot().variances[self.league.pk]["First1 Last1"]
+        self.assertAlmostEqual(variances[ratings.SKILLS.index('attack')], expected)
+
+    def test_lopsided_match(self):
+        strong, weak = self.team("Strong 0", "Strong 1", "Strong 2"), self.team("Weak 0", "Weak 1", "Weak 2")
+        self.assertEqual(strong.win_probability(weak), 1)
+        self.assertEqual(weak.win_probability(strong), 0)
+
+    def test_mirrored_match_is_even(self):
+        names = ["First1 Last1", "First2 Last2", "Nobody Yet"]
+        with self.assertLogs('myapp.teamBalancer', 'WARNING'):  # Nobody Yet plays at the default score
+            self.assertAlmostEqual(self.team(*names).win_probability(self.team(*names)), 0.5, delta=0.03)
+
+    def test_pinned_numpy(self):
+        # numpy 1.16, as pinned in requirements.txt, has no np.random.default_rng or Generator API
+        import numpy as np
+        with mock.patch.object(np.random, 'default_rng', side_effect=AttributeError("not in numpy 1.16")), \
+                mock.patch.object(np.random, 'Generator', side_effect=AttributeError("not in numpy 1.16")):
+            strong, weak = self.team("Strong 0", "Strong 1", "Strong 2"), self.team("Weak 0", "Weak 1", "Weak 2")
+            self.assertEqual(strong.win_probability(weak), 1)
+
+    def test_balanced_split_includes_win_probability(self):
+        teams = balance_teams([f"First{i} Last{i}" for i in range(6)], team_size=None, league=self.league)
+        self.assertAlmostEqual(sum(teams['win_probability'].values()), 1)
+
+
+class AdminTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.league = get_default_league()
+        cls.users = seed_club(n_users=12, league=cls.league)
+        cls.admin = User.objects.create_superuser("admin", "admin@example.com", "not-a-real-password")
+        Roster.objects.bulk_create(Roster(league=cls.league, user=user, players="['a', 'b']") for user in cls.users)
+
+    def setUp(self):
+        cache.clear()
+        self.client.force_login(self.admin)
+
+    def test_changelists_dont_query_per_row(self):
+        # session, user, leagues to filter by, count, page
+        for name in ('admin:myapp_votes_changelist', 'admin:myapp_roster_changelist'):
+            with self.assertNumQueries(5):
+                self.assertEqual(self.client.get(reverse(name)).status_code, 200)
+
+    @override_settings(QUERY_BUDGETS_ENFORCED=True)
+    def test_player_ratings(self):
+        response = self.client.get(reverse('admin:myapp_votes_ratings'))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context['page'].paginator.count, 12)
+
+        expected = Votes.objects.filter(player="First0 Last0").aggregate(avg=Avg('attack'))['avg']
+        player, votes, averages, overall = response.context['rows'][0]
+        self.assertEqual((player, votes), ("First0 Last0", 11))
+        self.assertAlmostEqual(averages[SKILLS.index('attack')], expected)
+        self.assertAlmostEqual(overall, Player(player, self.league).get_overall_score())
+
+    def test_player_ratings_without_leagues(self):
+        Votes.objects.all().delete()
+        Roster.objects.all().delete()
+        League.objects.all().delete()
+
+        response = self.client.get(reverse('admin:myapp_votes_ratings'))
+        self.assertContains(response, "There are no leagues yet.")
+        self.assertFalse(League.objects.exists())
+
+
+class StaticFilesTests(TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        super(StaticFilesTests, cls).setUpClass()
+        cls.static_root = tempfile.mkdtemp()
+        cls.settings = override_settings(STATIC_ROOT=cls.static_root,
+                                         STATICFILES_STORAGE='myapp.storage.CompressedManifestStaticFilesStorage')
+        cls.settings.enable()
+        call_command('collectstatic', interactive=False, verbosity=0)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.settings.disable()
+        shutil.rmtree(cls.static_root)
+        super(StaticFilesTests, cls).tearDownClass()
+
+    def test_templates_use_hashed_names(self):
+        url = Template("{% load static %}{% static 'css/style.css' %}").render(Context())
+        self.assertRegex(url, r"^/myapp/static/css/style\.[0-9a-f]{12}\.css$")
+        self.assertTrue(os.path.isfile(os.path.join(self.static_root, url[len('/myapp/static/'):] + '.gz')))
+
+    def test_gzipped_copies_are_reproducible_on_python_37(self):
+        from django.contrib.staticfiles.storage import staticfiles_storage
+
+        name = staticfiles_storage.stored_name('css/style.css')
+        os.remove(os.path.join(self.static_root, name + '.gz'))
+
+        # As on App Engine's Python 3.7, where gzip.compress() takes no mtime
+        with mock.patch('gzip.compress', side_effect=TypeError("unexpected keyword argument 'mtime'")):
+            self.assertEqual(staticfiles_storage.compress(name), name + '.gz')
+        with open(os.path.join(self.static_root, name + '.gz'), 'rb') as f:
+            self.assertEqual(f.read()[4:8], b"\0\0\0\0")  # no timestamp in the header
+
+    def test_hashed_file_served_gzipped_and_cached_for_a_year(self):
+        url = Template("{% load static %}{% static 'css/style.css' %}").render(Context())
+        response = self.client.get(url, HTTP_ACCEPT_ENCODING='gzip, deflate')
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertEqual(response['Content-Type'], 'text/css')
+        self.assertIn('Accept-Encoding', response['Vary'])
+        self.assertIn('immutable', response['Cache-Control'])
+
+        with open(os.path.join(settings.BASE_DIR, 'myapp', 'static', 'css', 'style.css'), 'rb') as f:
+            self.assertEqual(gzip.decompress(b"".join(response.streaming_content)), f.read())
+
+    def test_unhashed_file_served_plain_and_revalidated(self):
+        response = self.client.get('/myapp/static/css/style.css')
+        self.assertNotIn('Content-Encoding', response)
+        self.assertEqual(response['Cache-Control'], 'public, max-age=300')
+
+    def test_paths_outside_static_root_not_served(self):
+        self.assertEqual(self.client.get('/myapp/static/../manage.py').status_code, 404)
+
+
+class UncollectedStaticFilesTests(TestCase):
+
+    def test_pages_work_before_collectstatic(self):
+        static_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, static_root)
+        with override_settings(STATIC_ROOT=static_root,
+                               STATICFILES_STORAGE='myapp.storage.CompressedManifestStaticFilesStorage'), \
+                self.assertLogs('myapp.storage', 'WARNING'):
+            url = Template("{% load static %}{% static 'css/style.css' %}").render(Context())
+            self.assertEqual(url, '/myapp/static/css/style.css')
+            self.assertEqual(self.client.get(reverse('home')).status_code, 200)
+
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response['Cache-Control'], 'public, max-age=300')
+
+
+class FragmentCacheTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.league = get_default_league()
+        cls.users = seed_club(n_users=8, league=cls.league)
+
+    def setUp(self):
+        cache.clear()
+        self.client.force_login(self.users[0])
+
+    def test_warm_vote_list_skips_vote_queries(self):
+        self.client.get(reverse('vote_list'))
+        with self.assertNumQueries(2):  # session and user
+            self.assertContains(self.client.get(reverse('vote_list')), "First1 Last1")
+
+    def test_vote_edit_invalidates_vote_list(self):
+        vote = Votes.objects.get(user=self.users[0], player="First1 Last1")
+        Votes.objects.filter(pk=vote.pk).update(**{skill: 3 for skill in SKILLS})
+        tens = self.client.get(reverse('vote_list')).content.count(b"<td>10</td>")
+
+        self.client.post(reverse('vote_edit', kwargs={'pk': vote.pk}), {skill: 10 for skill in SKILLS})
+        self.assertEqual(self.client.get(reverse('vote_list')).content.count(b"<td>10</td>"), tens + 5)
+
+    def test_warm_team_rosters_skips_balancing(self):
+        self.client.post(reverse('roster_selection'), {'players': [f"First{i} Last{i}" for i in range(6)]})
+        first = self.client.get(reverse('team_rosters'))
+
+        with mock.patch('myapp.teamBalancer.balance_teams', side_effect=AssertionError("balanced again")):
+            with self.assertNumQueries(3):  # session, user and the roster's saved split
+                second = self.client.get(reverse('team_rosters'))
+        self.assertEqual(second.content, first.content)
+
+    def test_unsaved_roster_cached(self):
+        session = self.client.session
+        session['players'] = [f"First{i} Last{i}" for i in range(6)]
+        session.save()
+        first = self.client.get(reverse('team_rosters'))
+        with mock.patch('myapp.teamBalancer.balance_teams', side_effect=AssertionError("balanced again")):
+            with self.assertNumQueries(2):  # session and user
+                second = self.client.get(reverse('team_rosters'))
+        self.assertEqual(second.content, first.content)
+
+    def test_resubmitted_roster_saves_its_split(self):
+        players = [f"First{i} Last{i}" for i in range(6)]
+        for _ in range(2):
+            self.client.post(reverse('roster_selection'), {'players': players})
+            self.client.get(reverse('team_rosters'))
+        self.assertEqual([bool(roster.get_result()) for roster in Roster.objects.order_by('pk')], [True, True])
+
+    def test_saved_split_kept_after_new_vote(self):
+        self.client.post(reverse('roster_selection'), {'players': [f"First{i} Last{i}" for i in range(6)]})
+        self.client.get(reverse('team_rosters'))
+        played = Roster.objects.get().result
+        Votes.objects.get(user=self.users[1], player="First2 Last2").save()  # signals a ratings change
+        cache.clear()
+
+        with mock.patch('myapp.teamBalancer.balance_teams', side_effect=AssertionError("balanced again")):
+            self.assertEqual(self.client.get(reverse('team_rosters')).status_code, 200)
+        self.assertEqual(Roster.objects.get().result, played)
+
+    def test_new_vote_rebalances_unsaved_roster(self):
+        session = self.client.session
+        session['players'] = [f"First{i} Last{i}" for i in range(6)]
+        session.save()
+        self.client.get(reverse('team_rosters'))
+        Votes.objects.filter(user=self.users[1], player="First2 Last2").update(attack=1)
+        Votes.objects.get(user=self.users[1], player="First2 Last2").save()  # signals the ratings change
+
+        with mock.patch('myapp.teamBalancer.balance_teams', return_value={}) as balance_teams:
+            self.client.get(reverse('team_rosters'))
+        balance_teams.assert_called_once()
+
+    def test_no_split_is_not_saved(self):
+        self.client.post(reverse('roster_selection'), {'players': [f"First{i} Last{i}" for i in range(6)]})
+        with mock.patch('myapp.teamBalancer.balance_teams', return_value=None):
+            self.assertContains(self.client.get(reverse('team_rosters')), "couldn't be split")
+        self.assertEqual(Roster.objects.get().result, '')
+
+
+@override_settings(BALANCE_ASYNC_MIN_PLAYERS=6, QUERY_BUDGETS_ENFORCED=True)
+class BalancingJobTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.league = get_default_league()
+        cls.users = seed_club(n_users=8, league=cls.league)
+
+    def setUp(self):
+        cache.clear()
+        self.client.force_login(self.users[0])
+
+    def submit(self, n_players):
+        return self.client.post(reverse('roster_selection'), {'players': [f"First{i} Last{i}" for i in range(n_players)]})
+
+    def test_small_roster_balanced_in_request(self):
+        self.assertRedirects(self.submit(4), reverse('team_rosters'))
+        self.assertFalse(BalancingJob.objects.exists())
+
+    def test_big_roster_balanced_in_background(self):
+        response = self.submit(6)
+        job = BalancingJob.objects.get()
+        self.assertRedirects(response, reverse('balancing_job', kwargs={'pk': job.pk}))
+        self.assertEqual(job.get_players(), [f"First{i} Last{i}" for i in range(6)])
+
+        status_url = reverse('balancing_job_status', kwargs={'pk': job.pk})
+        self.assertEqual(self.client.get(status_url).json(), {'status': 'queued', 'error': ''})
+        self.assertContains(self.client.get(response.url), status_url)
+
+        self.assertTrue(jobs.run_job(job.pk))
+        self.assertEqual(self.client.get(status_url).json()['status'], 'done')
+        teams = self.client.get(response.url).context['teams']
+        self.assertEqual(len(teams['team_a']) + len(teams['team_b']), 6)
+
+    def test_job_only_runs_once(self):
+        self.submit(6)
+        job = BalancingJob.objects.get()
+        self.assertEqual(jobs.run_queued_jobs(), 1)
+        self.assertFalse(jobs.run_job(job.pk))
+
+    def test_failed_job_reports_error(self):
+        self.submit(6)
+        job = BalancingJob.objects.get()
+        with mock.patch('myapp.teamBalancer.balance_teams', side_effect=ValueError("boom")), \
+                self.assertLogs('myapp.jobs', 'ERROR'):
+            jobs.run_job(job.pk)
+        response = self.client.get(reverse('balancing_job_status', kwargs={'pk': job.pk}))
+        self.assertEqual(response.json(), {'status': 'failed', 'error': 'boom'})
+
+    def test_job_left_running_is_requeued(self):
+        self.submit(6)
+        job = BalancingJob.objects.get()
+        jobs.claim(job.pk)  # and the worker went away
+        status_url = reverse('balancing_job_status', kwargs={'pk': job.pk})
+        self.assertEqual(self.client.get(status_url).json()['status'], 'running')
+
+        BalancingJob.objects.filter(pk=job.pk).update(
+            started_date=timezone.now() - timedelta(seconds=settings.BALANCING_JOB_TIMEOUT + 1))
+        self.assertEqual(self.client.get(status_url).json()['status'], 'queued')
+        self.assertEqual(jobs.run_queued_jobs(), 1)
+        self.assertEqual(self.client.get(status_url).json()['status'], 'done')
+
+    def test_job_that_keeps_timing_out_fails(self):
+        self.submit(6)
+        job = BalancingJob.objects.get()
+        long_ago = timezone.now() - timedelta(seconds=settings.BALANCING_JOB_TIMEOUT + 1)
+        with self.assertLogs('myapp.jobs', 'WARNING'):
+            for _ in range(jobs.MAX_ATTEMPTS):
+                jobs.claim(job.pk)
+                BalancingJob.objects.filter(pk=job.pk).update(started_date=long_ago)
+                jobs.requeue_stale()
+        self.assertEqual(jobs.run_queued_jobs(), 0)
+        response = self.client.get(reverse('balancing_job_status', kwargs={'pk': job.pk}))
+        self.assertEqual(response.json(), {'status': 'failed', 'error': "The roster took too long to balance."})
+
+    def test_other_users_jobs_are_hidden(self):
+        self.submit(6)
+        job = BalancingJob.objects.get()
+        self.client.force_login(self.users[1])
+        self.assertEqual(self.client.get(reverse('balancing_job_status', kwargs={'pk': job.pk})).status_code, 404)
+
+
+class RatingsHistoryTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.league = get_default_league()
+        cls.users = seed_club(n_users=6, league=cls.league)
+
+    def setUp(self):
+        cache.clear()
+
+    def test_history_round_trip(self):
+        current = ratings.refresh()
+        with self.assertNumQueries(4):  # savepoint, the history, its rows in one batch, release
+            history, = ratings.save_history(current)
+        self.assertEqual(history.rows.count(), 6)
+
+        loaded = ratings.load_history(history)
+        for player, averages in current.for_league(self.league.pk).items():
+            for saved, expected in zip(loaded.get(player, self.league.pk), averages):
+                self.assertAlmostEqual(saved, expected, places=5)
+
+    def test_balance_as_of_history(self):
+        history, = ratings.save_history(ratings.refresh())
+        before = Player("First1 Last1", self.league).get_overall_score()
+        Votes.objects.filter(player="First1 Last1").update(**{skill: 10 for skill in SKILLS})
+        ratings.refresh()
+
+        snapshot = ratings.load_history(history)
+        self.assertAlmostEqual(Player("First1 Last1", self.league, snapshot=snapshot).get_overall_score(), before,
+                               places=5)
+        self.assertEqual(Player("First1 Last1", self.league).get_overall_score(), 10)
+
+    def test_refresher_saves_history_when_due(self):
+        refresher = ratings.SnapshotRefresher(interval=300, poll=5)
+        refresher.history_interval = 3600
+        ratings.refresh()
+        refresher.save_history_if_due()
+        refresher.save_history_if_due()
+        self.assertEqual(RatingsHistory.objects.count(), 1)
+
+    def test_replay_rosters(self):
+        players = "['First0 Last0', 'First1 Last1', 'First2 Last2', 'First3 Last3']"
+        now = timezone.now()
+        early = Roster.objects.create(league=self.league, user=self.users[0], players=players,
+                                      published_date=now - timedelta(days=2))
+        history, = ratings.save_history(ratings.refresh())
+        RatingsHistory.objects.filter(pk=history.pk).update(created_date=now - timedelta(days=1))
+        played = {'team_a': ['First0 Last0', 'First1 Last1'], 'team_b': ['First2 Last2', 'First3 Last3']}
+        late = Roster.objects.create(league=self.league, user=self.users[0], players=players, published_date=now,
+                                     result=json.dumps(played))
+
+        out = StringIO()
+        call_command('replay_rosters', stdout=out)
+        self.assertIn("Replayed 1 roster(s), skipped 1", out.getvalue())
+
+        late.refresh_from_db()
+        self.assertEqual(late.ratings_history, history)
+        teams = late.get_replayed_result()
+        self.assertEqual(sorted(teams['team_a'] + teams['team_b']), late.get_players())
+        self.assertEqual(late.get_result(), played)  # the split that was played is kept
+        early.refresh_from_db()
+        self.assertEqual(early.replayed_result, '')
+
+
+class ExportTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.league = get_default_league()
+        cls.users = seed_club(n_users=8, league=cls.league)
+        cls.result = {'team_a': ['First0 Last0', 'First1 Last1'], 'team_b': ['First2 Last2', 'First3 Last3'],
+                      'win_probability': {'team_a': 0.48, 'team_b': 0.52}}
+        cls.roster = Roster.objects.create(league=cls.league, user=cls.users[0], published_date=timezone.now(),
+                                           players=str(cls.result['team_a'] + cls.result['team_b']),
+                                           result=json.dumps(cls.result))
+        Roster.objects.create(league=cls.league, user=cls.users[0], players="[]")  # never published
+
+    def setUp(self):
+        cache.clear()
+        self.client.force_login(self.users[0])
+
+    def download(self, name, fmt):
+        response = self.client.get(reverse(name, args=[fmt]))
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.streaming)
+        # Rows are only read from the database as the response streams, all of them by one query
+        with self.assertNumQueries(1):
+            return b"".join(response.streaming_content).decode()
+
+    def test_ratings_csv(self):
+        rows = list(csv.DictReader(StringIO(self.download('export_ratings', 'csv'))))
+        self.assertEqual(len(rows), 8)
+        averages = Votes.objects.filter(league=self.league, player="First0 Last0").aggregate(Avg('attack'))
+        first = next(row for row in rows if row['player'] == "First0 Last0")
+        self.assertEqual(first['votes'], '7')
+        self.assertAlmostEqual(float(first['attack']), averages['attack__avg'])
+
+    def test_ratings_json(self):
+        rows = json.loads(self.download('export_ratings', 'json'))
+        self.assertEqual([row['player'] for row in rows], sorted(row['player'] for row in rows))
+        self.assertEqual(set(rows[0]), {'player', 'votes', 'overall'} | set(SKILLS))
+
+    def test_rosters_csv(self):
+        row, = csv.DictReader(StringIO(self.download('export_rosters', 'csv')))
+        self.assertEqual(row['roster'], str(self.roster.pk))
+        self.assertEqual(row['team_a'], "First0 Last0; First1 Last1")
+        self.assertEqual(float(row['team_a_win_probability']), 0.48)
+
+    def test_rosters_json(self):
+        row, = json.loads(self.download('export_rosters', 'json'))
+        self.assertEqual(row['team_b'], self.result['team_b'])
+        self.assertEqual(row['user'], self.users[0].username)
+
+    def test_unknown_format(self):
+        self.assertEqual(self.client.get(reverse('export_ratings', args=['xlsx'])).status_code, 404)
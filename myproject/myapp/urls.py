@@ -2,15 +2,22 @@ from django.urls import path
 from django.views.generic.base import TemplateView
 
 from . import views
+from .instrumentation import query_budget
 
 urlpatterns = [
-    path('', TemplateView.as_view(template_name='home.html'), name='home'),
+    path('', query_budget(3)(TemplateView.as_view(template_name='home.html')), name='home'),
     path('vote/list', views.vote_list, name='vote_list'),
     path('vote/new/', views.vote_new, name='vote_new'),
+    path('vote/bulk/', views.vote_bulk, name='vote_bulk'),
     path('vote/<int:pk>/', views.vote_detail, name='vote_detail'),
     path('vote/<int:pk>/edit/', views.vote_edit, name='vote_edit'),
     path('signup/', views.SignUp.as_view(), name='signup'),
     path('roster_selection/', views.roster, name='roster_selection'),
     path('roster_thanks/', views.roster_thanks, name='thank_you'),
-    path('team_rosters/', views.team_rosters, name='team_rosters')
+    path('team_rosters/', views.team_rosters, name='team_rosters'),
+    path('team_rosters/<int:pk>/', views.balancing_job, name='balancing_job'),
+    path('team_rosters/<int:pk>/status/', views.balancing_job_status, name='balancing_job_status'),
+    path('export/ratings.<str:fmt>', views.export_ratings, name='export_ratings'),
+    path('export/rosters.<str:fmt>', views.export_rosters, name='export_rosters'),
+    path('league/<slug:slug>/', views.league_switch, name='league_switch'),
 ]
@@ -0,0 +1,91 @@
+# versions.py
+# Version counters for cached data. Anything cached from the database includes the relevant version in its cache key,
+# and writes bump the version instead of hunting down every key that might be stale. Versions only invalidate across
+# processes if they share the cache (see CACHES in settings.py); they expire with everything else after CACHE_TIMEOUT.
+# Within a request (see VersionsMiddleware) each version is only fetched from the cache once.
+
+import threading
+import time
+from contextlib import contextmanager
+
+from django.core.cache import cache
+
+
+_local = threading.local()
+
+
+def _key(name):
+    return f"myapp:version:{name}"
+
+
+@contextmanager
+def remembered():
+    """
+    Remember every version read or bumped in the block, so reading it again costs nothing. Meant to wrap a request,
+    which is short enough not to miss a bump made elsewhere in the meantime.
+    """
+    previous = getattr(_local, 'versions', None)
+    _local.versions = {} if previous is None else previous
+    try:
+        yield
+    finally:
+        _local.versions = previous
+
+
+def get_version(name):
+    """
+    Get the current version of a piece of cached data.
+    :param name: Name of the data, e.g. 'directory:<league id>' or 'votes:<user id>'.
+    :return: The version, which only ever goes up
+    :rtype: int
+    """
+    versions = getattr(_local, 'versions', None)
+    if versions is not None and name in versions:
+        return versions[name]
+
+    version = cache.get(_key(name))
+    if version is None:
+        # Start from the clock rather than 1, so a version evicted from the cache can't come back as an older number
+        cache.add(_key(name), int(time.time() * 1000))
+        version = cache.get(_key(name))
+    if versions is not None:
+        versions[name] = version
+    return version
+
+
+def get_versions(names):
+    """
+    Get the current versions of several pieces of cached data with one cache round trip.
+    :param names: Names of the data, e.g. 'ratings:<league id>' for each league.
+    :return: Dictionary of name to version
+    :rtype: dict
+    """
+    versions = getattr(_local, 'versions', None)
+    found = {name: versions[name] for name in names if versions is not None and name in versions}
+    missing = [name for name in names if name not in found]
+    if missing:
+        cached = cache.get_many([_key(name) for name in missing])
+        for name in missing:
+            version = cached.get(_key(name))
+            found[name] = get_version(name) if version is None else version
+            if versions is not None:
+                versions[name] = found[name]
+    return found
+
+
+def bump_version(name):
+    """
+    Invalidate everything cached under the current version of a piece of data.
+    :param name: Name of the data.
+    :return: The new version
+    :rtype: int
+    """
+    try:
+        version = cache.incr(_key(name))
+    except ValueError:  # not cached yet, or evicted
+        version = int(time.time() * 1000)
+        cache.set(_key(name), version)
+    versions = getattr(_local, 'versions', None)
+    if versions is not None:
+        versions[name] = version
+    return version
@@ -1,63 +1,125 @@
+import hashlib
+import json
+
 from django.shortcuts import render, redirect, get_object_or_404
 from django.utils import timezone
 from django.urls import reverse_lazy
 from django.views import generic
-from django.http import HttpResponseForbidden
-from django.contrib.auth.models import User
+from django.http import Http404, HttpResponseForbidden, JsonResponse
 from django.contrib import messages
+from django.db import transaction
+from django.utils.decorators import method_decorator
+from django.utils.functional import SimpleLazyObject
 
-from .forms import VotingForm, RegistrationForm, RosterForm
-from .models import Votes
-
-from .teamBalancer import *
+from .forms import VotingForm, RegistrationForm, RosterForm, bulk_vote_formset
+from .models import BalancingJob, League, Roster, Votes
+from .instrumentation import query_budget
+from .leagues import get_active_league, get_default_league, get_weight_profiles, join_league, switch_league
+from .signals import votes_changed
+from .versions import get_version
+from . import directory, exports, jobs, ratings
 
 
+@method_decorator(query_budget(7), name='dispatch')
 class SignUp(generic.CreateView):
     form_class = RegistrationForm
     success_url = reverse_lazy('login')
     template_name = 'signup.html'
 
+    def form_valid(self, form):
+        """
+        New players join the league they were invited to with ?league=<slug>, or the default league.
+        """
+        response = super(SignUp, self).form_valid(form)
+        slug = self.request.GET.get('league')
+        league = slug and League.objects.filter(slug=slug).first() or get_default_league()
+        join_league(self.object, league)
+        return response
 
+
+@query_budget(6)
 def vote_list(request):
     """
-    Show all votes submitted by the user.
+    Show all votes submitted by the user in their current league.
     :param request:
     :return:
     """
-    posts = Votes.objects.filter(user=request.user).order_by('published_date')
-    user_count = User.objects.values().exclude(id=request.user.id).count()
-    progress = {
-        'user_count': User.objects.values().exclude(id=request.user.id).count(),
-        'post_count': Votes.objects.filter(user=request.user).count()
-    }
-    return render(request, 'vote_list.html', {'posts': posts, 'progress': progress})
+    league = get_active_league(request)
+    # Nothing below is looked up until the template renders it, so a cached fragment skips the queries too
+    posts = Votes.objects.filter(league=league, user=request.user).order_by('published_date')
+    progress = SimpleLazyObject(lambda: {
+        'user_count': len(directory.get_players(league)) - 1,
+        'post_count': len(posts)
+    })
+    return render(request, 'vote_list.html', {
+        'posts': posts,
+        'progress': progress,
+        'votes_version': get_version(f'votes:{request.user.id}'),
+        'directory_version': get_version(f'directory:{league.pk}'),
+    })
 
 
+@query_budget(5)
 def vote_new(request):
+    league = get_active_league(request)
     if request.method == "POST":
-        form = VotingForm(request.POST)
+        form = VotingForm(request.POST, league=league)
         if form.is_valid():
             post = form.save(commit=False)
+            post.league = league
             post.user = request.user
             post.published_date = timezone.now()
             post.save()
             return redirect('vote_edit', pk=post.pk)
     else:
-        form = VotingForm(uid=request.user.id)  # passes User ID to form class to exclude current user from drop-down
+        form = VotingForm(uid=request.user.id, league=league)  # passes User ID to form class to exclude current user from drop-down
     return render(request, 'votingForm.html', {'form': form})
 
 
+@query_budget(9)
+def vote_bulk(request):
+    """
+    Rate many players at once. The whole page is validated together and saved in one transaction, with a single
+    bulk insert for new votes and a single bulk update for changed ones.
+    :param request:
+    :return:
+    """
+    league = get_active_league(request)
+    if request.method == "POST":
+        formset = bulk_vote_formset(request.user.id, league, data=request.POST)
+        if formset.is_valid():
+            created, updated = formset.votes_to_save()
+            now = timezone.now()
+            for vote in created + updated:
+                vote.league = league
+                vote.user = request.user
+                vote.published_date = now
+
+            with transaction.atomic():
+                Votes.objects.bulk_create(created)
+                Votes.objects.bulk_update(updated, ['attack', 'defense', 'possession', 'stamina', 'mobility',
+                                                    'published_date'])
+            votes_changed(request.user.id, league.pk)  # once for the whole batch
+
+            return redirect('vote_list')
+    else:
+        formset = bulk_vote_formset(request.user.id, league)
+    return render(request, 'vote_bulk.html', {'formset': formset})
+
+
+@query_budget(4)
 def vote_detail(request, pk):
     post = get_object_or_404(Votes, pk=pk)
-    if post.user == request.user:
+    if post.user_id == request.user.id:
         return render(request, 'vote_detail.html', {'post': post})
     else:
         return HttpResponseForbidden("You can't view this vote.")
 
 
+@query_budget(4)
 def vote_edit(request, pk):
     post = get_object_or_404(Votes, pk=pk)
-    if not post.user == request.user:
+    if not post.user_id == request.user.id:
         return HttpResponseForbidden("Oi cheeky! You can't edit this vote.")
     if request.method == "POST":
         form = VotingForm(request.POST, instance=post)
@@ -73,31 +135,196 @@ def vote_edit(request, pk):
     return render(request, 'vote_edit.html', {'form': form})
 
 
+@query_budget(3)
 def roster_thanks(request):
     return render(request, 'roster_thanks.html', {})
 
 
+@query_budget(10)
 def roster(request):
+    league = get_active_league(request)
     if request.method == "POST":
-        form = RosterForm(request.POST)
+        form = RosterForm(request.POST, league=league)
         if form.is_valid():
             post = form.save(commit=False)
+            post.league = league
             post.user = request.user
             post.published_date = timezone.now()
             players = request.POST.getlist('players')  # sets player selection as a session variable
             request.session['players'] = players
+            # The weights themselves go in the session, so balancing doesn't have to look the profile up again
+            profile = post.weight_profile
+            request.session['weights'] = profile.as_weights() if profile else None
+            request.session['weight_profile'] = profile.name if profile else None
             post.save()
+            request.session['roster_id'] = post.pk
+            # Big rosters take too long to balance within the request, so they're balanced in the background
+            if jobs.is_big(players):
+                job = jobs.enqueue(post, players, request.session['weights'])
+                return redirect('balancing_job', pk=job.pk)
             return redirect('team_rosters')
     else:
-        form = RosterForm()
+        form = RosterForm(league=league)
     return render(request, 'roster_selection.html', {'form': form})
 
 
+@query_budget(5)
 def team_rosters(request):
-
+    """
+    Show the teams the user's roster is split into. A saved roster is balanced once, the first time it's shown, and
+    that split is kept on the roster as the one that was played, so it's shown from then on. Rosters that weren't
+    saved are balanced whenever the ratings change.
+    :param request:
+    :return:
+    """
     players = request.session.get('players')
-    print(players)
+    weights = request.session.get('weights')
+    roster_id = request.session.get('roster_id')
+
+    def balance():
+        # Imported here so that workers only load the balancer once a request actually needs it
+        from .teamBalancer import balance_teams
+
+        return balance_teams(players, team_size=None, threshold=0.5, max_cycles=5, league=get_active_league(request),
+                             weights=weights) or {}
+
+    roster = roster_id and Roster.objects.filter(pk=roster_id, user_id=request.user.id).only('result').first()
+    if roster:
+        teams = roster.get_result()
+        if teams is None:
+            teams = balance()
+            # Only a split that was found is kept, and only the first one if the page was opened twice at once
+            if teams and not Roster.objects.filter(pk=roster.pk, result='').update(result=json.dumps(teams)):
+                teams = Roster.objects.get(pk=roster.pk).get_result()
+        return render(request, 'team_rosters.html', {
+            'teams': teams,
+            'weight_profile': request.session.get('weight_profile'),
+            'roster_fingerprint': f"roster:{roster.pk}",  # a saved split never changes
+            'ratings_version': None,
+        })
+
+    # Teams are only balanced if the template's cached fragment for this roster and the league's ratings is missing
+    league = get_active_league(request)
+    league_id = league.pk if league else None
+    return render(request, 'team_rosters.html', {
+        'teams': SimpleLazyObject(balance),
+        'weight_profile': request.session.get('weight_profile'),
+        'roster_fingerprint': roster_fingerprint(players, league, weights),
+        'ratings_version': ratings.get_snapshot(league_id).versions.get(league_id),
+    })
+
+
+@query_budget(3)
+def balancing_job(request, pk):
+    """
+    Show a queued roster's teams once they've been balanced, or a page that waits for them until then.
+    :param request:
+    :param pk: ID of the balancing job.
+    :return:
+    """
+    job = get_object_or_404(BalancingJob.objects.select_related('roster__weight_profile'), pk=pk,
+                            user_id=request.user.id)
+    if job.status != BalancingJob.DONE:
+        return render(request, 'balancing_job.html', {'job': job})
+
+    profile = job.roster.weight_profile if job.roster else None
+    return render(request, 'team_rosters.html', {
+        'teams': job.get_result(),
+        'weight_profile': profile.name if profile else None,
+        'roster_fingerprint': f"job:{job.pk}",  # a job's result never changes
+        'ratings_version': None,
+    })
 
-    teams = balance_teams(players, team_size=None, threshold=0.5, max_cycles=5)
 
-    return render(request, 'team_rosters.html', teams)
+@query_budget(6)
+def balancing_job_status(request, pk):
+    """
+    Lightweight status check for the waiting page to poll. A job whose worker went away is requeued here, so the page
+    doesn't wait for it forever.
+    :param request:
+    :param pk: ID of the balancing job.
+    :return: JSON with the job's status, and its error if it failed
+    """
+    job = BalancingJob.objects.filter(pk=pk, user_id=request.user.id).values('status', 'error', 'started_date').first()
+    if job is None:
+        raise Http404("No such balancing job.")
+    if job['status'] == BalancingJob.RUNNING and jobs.is_stale(job['started_date']):
+        if jobs.resume_stale(pk):
+            job['status'] = BalancingJob.QUEUED
+        else:  # tried too often, and failed
+            job = BalancingJob.objects.values('status', 'error').get(pk=pk)
+    return JsonResponse({'status': job['status'], 'error': job['error']})
+
+
+@query_budget(4)
+def export_ratings(request, fmt):
+    """
+    Download every player's ratings in the user's current league: votes, average per skill and overall score under
+    the league's default weight profile. The rows come from one grouped query, which only runs as the file streams.
+    :param request:
+    :param fmt: 'csv' or 'json'.
+    :return:
+    """
+    league = get_active_league(request)
+    if league is None or fmt not in exports.FORMATS:
+        raise Http404("No such export.")
+    profiles = get_weight_profiles(league)
+    rows = ratings.player_ratings(league, profiles[0].as_weights() if profiles else None)
+
+    header = ['player', 'votes'] + list(ratings.SKILLS) + ['overall']
+    columns = ['player', 'votes'] + [f"avg_{skill}" for skill in ratings.SKILLS] + ['overall']
+    return exports.export_response(fmt, f"ratings-{league.slug}", header, (
+        [row[column] for column in columns] for row in rows.iterator(chunk_size=exports.CHUNK_SIZE)))
+
+
+@query_budget(3)
+def export_rosters(request, fmt):
+    """
+    Download the published rosters in the user's current league, oldest first, with the teams they were split into.
+    :param request:
+    :param fmt: 'csv' or 'json'.
+    :return:
+    """
+    league = get_active_league(request)
+    if league is None or fmt not in exports.FORMATS:
+        raise Http404("No such export.")
+    rosters = (Roster.objects.filter(league=league, published_date__isnull=False).order_by('published_date')
+               .select_related('user', 'weight_profile')
+               .only('published_date', 'players', 'result', 'ratings_history_id', 'user__username',
+                     'weight_profile__name'))
+
+    def rows():
+        for roster in rosters.iterator(chunk_size=exports.CHUNK_SIZE):
+            result = roster.get_result() or {}
+            win_probability = result.get('win_probability') or {}
+            yield [roster.pk, roster.published_date, roster.user.username,
+                   roster.weight_profile.name if roster.weight_profile else None, roster.get_players(),
+                   result.get('team_a', []), result.get('team_b', []), win_probability.get('team_a'),
+                   roster.ratings_history_id]
+
+    header = ['roster', 'published_date', 'user', 'weight_profile', 'players', 'team_a', 'team_b',
+              'team_a_win_probability', 'ratings_history']
+    return exports.export_response(fmt, f"rosters-{league.slug}", header, rows())
+
+
+def roster_fingerprint(players, league, weights):
+    """
+    :return: Digest identifying a roster: who's playing, in which league, with which skill weights
+    :rtype: str
+    """
+    roster = [sorted(players or []), league.pk if league else None, weights]
+    return hashlib.sha1(json.dumps(roster, sort_keys=True).encode()).hexdigest()
+
+
+@query_budget(7)
+def league_switch(request, slug):
+    """
+    Switch to another of the user's leagues.
+    :param request:
+    :param slug: Slug of the league to switch to.
+    :return:
+    """
+    league = get_object_or_404(League, slug=slug)
+    if not switch_league(request, league):
+        return HttpResponseForbidden("You're not a member of this league.")
+    return redirect('home')
@@ -11,6 +11,7 @@ https://docs.djangoproject.com/en/2.2/ref/settings/
 """
 
 import os
+import sys
 
 # Build paths inside the project like this: os.path.join(BASE_DIR, ...)
 BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
@@ -46,7 +47,11 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'myapp.middleware.StaticFilesMiddleware',
+    'myapp.middleware.PerformanceMiddleware',
+    'myapp.middleware.VersionsMiddleware',
     'django.middleware.security.SecurityMiddleware',
+    'myapp.middleware.ReplicaStickinessMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
@@ -68,6 +73,7 @@ TEMPLATES = [
                 'django.template.context_processors.request',
                 'django.contrib.auth.context_processors.auth',
                 'django.contrib.messages.context_processors.messages',
+                'myapp.context_processors.league',
             ],
         },
     },
@@ -112,6 +118,83 @@ else:
     }
 
 
+# Tests run against a local SQLite database: python manage.py test
+TESTING = len(sys.argv) > 1 and sys.argv[1] == 'test'
+
+if TESTING:
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': os.path.join(BASE_DIR, 'db.sqlite3'),
+        },
+        'replica': {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': os.path.join(BASE_DIR, 'db-replica.sqlite3'),
+        },
+    }
+
+# Read replica
+# Rating reads go to RATINGS_READ_DATABASE (an alias in DATABASES), everything else to 'default'. Sessions that have
+# just written stick to 'default' for REPLICA_STICKY_SECONDS. See myapp/routers.py.
+
+if os.getenv('REPLICA_DB_HOST'):
+    DATABASES['replica'] = dict(DATABASES['default'], HOST=os.getenv('REPLICA_DB_HOST'))
+
+DATABASE_ROUTERS = ['myapp.routers.RatingsReplicaRouter']
+RATINGS_READ_DATABASE = os.getenv('RATINGS_READ_DATABASE', 'replica' if os.getenv('REPLICA_DB_HOST') else 'default')
+REPLICA_STICKY_SECONDS = int(os.getenv('REPLICA_STICKY_SECONDS', 10))
+
+
+# Cache
+# Player directory and rating caches are keyed by version, see myapp/versions.py. Every worker process and instance
+# has to share the cache, or a vote saved by one never bumps the versions the others see, so production sets
+# MEMCACHED_LOCATION to its memcached nodes (host:port, comma separated), e.g. Memorystore for Memcached. The database
+# cache table, created by migrate, is a slower fallback: set CACHE_BACKEND=django.core.cache.backends.db.DatabaseCache
+# and CACHE_LOCATION=myapp_cache. Otherwise, e.g. in development and tests, each process has its own local memory
+# cache. Entries expire after CACHE_TIMEOUT seconds, which bounds how stale a cache that isn't shared can get.
+
+CACHE_TIMEOUT = int(os.getenv('CACHE_TIMEOUT', 300))
+
+if os.getenv('MEMCACHED_LOCATION') and not TESTING:
+    CACHE_BACKEND = 'django.core.cache.backends.memcached.MemcachedCache'
+    CACHE_LOCATION = os.getenv('MEMCACHED_LOCATION').split(',')
+elif os.getenv('CACHE_BACKEND') and not TESTING:
+    CACHE_BACKEND, CACHE_LOCATION = os.getenv('CACHE_BACKEND'), os.getenv('CACHE_LOCATION', 'myapp_cache')
+else:
+    CACHE_BACKEND, CACHE_LOCATION = 'django.core.cache.backends.locmem.LocMemCache', 'myapp'
+
+CACHES = {
+    'default': {
+        'BACKEND': CACHE_BACKEND,
+        'LOCATION': CACHE_LOCATION,
+        'TIMEOUT': CACHE_TIMEOUT,
+    }
+}
+
+
+# Ratings snapshot
+# Average skill ratings are held in memory for the balancer, see myapp/ratings.py. The snapshot is built when the WSGI
+# application is loaded (see myproject/wsgi.py), rebuilt in the background when a vote changes a league's ratings
+# version (checked every RATINGS_SNAPSHOT_POLL seconds) and rebuilt at least every RATINGS_SNAPSHOT_INTERVAL seconds to
+# pick up votes saved by other instances. Set RATINGS_SNAPSHOT_PRELOAD=False to build it on first use instead.
+
+RATINGS_SNAPSHOT_PRELOAD = os.getenv('RATINGS_SNAPSHOT_PRELOAD', str(not TESTING)) == 'True'
+RATINGS_SNAPSHOT_INTERVAL = int(os.getenv('RATINGS_SNAPSHOT_INTERVAL', 300))
+RATINGS_SNAPSHOT_POLL = int(os.getenv('RATINGS_SNAPSHOT_POLL', 5))
+# Seconds between saving the snapshot as RatingsHistory, for replaying past rosters; 0 turns it off
+RATINGS_HISTORY_INTERVAL = int(os.getenv('RATINGS_HISTORY_INTERVAL', 24 * 60 * 60))
+
+
+# Background balancing
+# Rosters of at least BALANCE_ASYNC_MIN_PLAYERS players are balanced by a pool of BALANCING_WORKERS threads instead of
+# within the request, see myapp/jobs.py. Jobs left queued by a restart are picked up by `manage.py run_balancing_jobs`.
+
+BALANCE_ASYNC_MIN_PLAYERS = int(os.getenv('BALANCE_ASYNC_MIN_PLAYERS', 14))
+BALANCING_WORKERS = int(os.getenv('BALANCING_WORKERS', 2))
+# Seconds after which a running job is taken to have lost its worker, e.g. to an instance shutting down, and requeued
+BALANCING_JOB_TIMEOUT = int(os.getenv('BALANCING_JOB_TIMEOUT', 600))
+
+
 # Password validation
 # https://docs.djangoproject.com/en/2.2/ref/settings/#auth-password-validators
 
@@ -152,6 +235,13 @@ STATIC_URL = '/myapp/static/'
 
 STATIC_ROOT = 'static'
 
+# collectstatic writes content-hashed copies of each file, a manifest that {% static %} looks them up in, and gzipped
+# copies. App Engine serves them from the handlers in app.yaml, and StaticFilesMiddleware everywhere else. They're
+# build output, collected before each deploy rather than checked in; until then pages link to, and the middleware
+# serves, the plain files. Tests keep the plain names.
+if not TESTING:
+    STATICFILES_STORAGE = 'myapp.storage.CompressedManifestStaticFilesStorage'
+
 # Specify where to redirect the user upon a successful login
 LOGIN_REDIRECT_URL = 'home'
 LOGOUT_REDIRECT_URL = 'home'
@@ -166,3 +256,27 @@ EMAIL_HOST_PASSWORD = 'Fozzyrock1!'
 EMAIL_PORT = 587
 EMAIL_USE_TLS = True
 DEFAULT_FROM_EMAIL = 'james.wolman@data-wrangler.co.uk'
+
+# Logging
+# Request metrics are logged as one JSON line per request by myapp.middleware.PerformanceMiddleware
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'handlers': {
+        'console': {
+            'class': 'logging.StreamHandler',
+        },
+    },
+    'loggers': {
+        'myapp': {
+            'handlers': ['console'],
+            'level': os.getenv('MYAPP_LOG_LEVEL', 'WARNING' if TESTING else 'INFO'),
+        },
+    },
+}
+
+# Send request timings back to the browser in a Server-Timing header
+PERFORMANCE_SERVER_TIMING = os.getenv('PERFORMANCE_SERVER_TIMING', 'False') == 'True'
+
+# Fail any request that runs more queries than its view's query_budget (see myapp.instrumentation)
+QUERY_BUDGETS_ENFORCED = os.getenv('QUERY_BUDGETS_ENFORCED', str(DEBUG or TESTING)) == 'True'
@@ -9,8 +9,15 @@ https://docs.djangoproject.com/en/2.2/howto/deployment/wsgi/
 
 import os
 
+from django.conf import settings
 from django.core.wsgi import get_wsgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'myproject.settings')
 
 application = get_wsgi_application()
+
+# Only processes serving requests keep the ratings snapshot fresh, so management commands never start the refresher
+if settings.RATINGS_SNAPSHOT_PRELOAD:
+    from myapp import ratings
+
+    ratings.start_refresher()